@@ -1,5 +1,5 @@
 # backend/app.py
-from flask import Flask, request, jsonify, send_file, make_response
+from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
 import subprocess
 import json
@@ -8,13 +8,78 @@ import uuid
 from datetime import datetime
 import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import sbom_store
+from blob_cache import open_blob_cache
+from http_cache import file_digest, payload_etag, precompress, remove_variants, send_json, send_report_file, task_etag
+from policy import build_index, compile_policy, failed_misconfigurations, load_default_policy
+from registry import RegistryError, resolve_digest
+from repo_cache import RefNotFound, RepoError, open_repo_cache
+from scheduler import Scheduler, validate_schedule
+from scanners import (SCANNER_TYPES, build_command, build_sbom_command, get_scanner, local_target, scan_timeout,
+                      validate_options, validate_target)
+from task_queue import open_queue
+from webhooks import WebhookDispatcher, completion_event, validate_callback_url
 
 app = Flask(__name__)
 CORS(app)
 
-SCAN_RESULTS_DIR = "/app/scan_results"
+SCAN_RESULTS_DIR = os.environ.get("SCAN_RESULTS_DIR", "/app/scan_results")
+
+# 启动时加载并校验默认策略，POLICY_FILE 配置错误直接退出，而不是让每个扫描失败
+load_default_policy()
 scan_tasks = {}
 
+# 配置 QUEUE_URL 后，API 只负责入队，扫描由 worker.py 执行
+task_queue = open_queue(os.environ.get("QUEUE_URL"))
+webhook_dispatcher = WebhookDispatcher()
+
+# 配置 BLOB_CACHE_DIR 后，镜像由服务拉取到本地 blob 缓存，trivy 从本地 OCI 布局扫描
+blob_cache = open_blob_cache(os.environ.get("BLOB_CACHE_DIR"))
+
+# 配置 REPO_CACHE_DIR 后，仓库扫描复用本地 bare 镜像，结果按提交缓存
+repo_cache = open_repo_cache(os.environ.get("REPO_CACHE_DIR"))
+
+# 本地模式下批量重扫使用的线程池（队列模式由 worker 并发执行）
+RESCAN_WORKERS = int(os.environ.get("RESCAN_WORKERS", "4"))
+rescan_pool = ThreadPoolExecutor(max_workers=RESCAN_WORKERS, thread_name_prefix='rescan')
+
+def get_task(task_id):
+    """获取任务；队列模式下从共享存储读取，已完成任务的结果从结果文件加载"""
+    if task_id in scan_tasks:
+        return scan_tasks[task_id]
+    if task_queue is None:
+        return None
+    
+    task = task_queue.get(task_id)
+    if task is None:
+        return None
+    
+    if task['status'] == 'completed':
+        result_file = os.path.join(SCAN_RESULTS_DIR, f"{task_id}.json")
+        try:
+            with open(result_file, 'r') as f:
+                task['result'] = json.load(f)
+        except (OSError, ValueError):
+            return task
+        # 已完成的任务不再变化，缓存在本地
+        scan_tasks[task_id] = task
+    
+    return task
+
+def notify_completion(task_id, task=None):
+    """任务结束后投递回调（如果设置了 callback_url）；task 不在本进程中时直接传入"""
+    task = task or scan_tasks.get(task_id)
+    if task and task.get('callback_url'):
+        webhook_dispatcher.submit(task['callback_url'], completion_event(task))
+
+def list_tasks():
+    """列出全部任务"""
+    if task_queue is None:
+        return list(scan_tasks.values())
+    return task_queue.list()
+
 def parse_vulnerabilities(result):
     """解析漏洞统计"""
     stats = {
@@ -22,7 +87,8 @@ def parse_vulnerabilities(result):
         'high': 0,
         'medium': 0,
         'low': 0,
-        'total': 0
+        'total': 0,
+        'misconfigurations': 0
     }
     
     if not result or 'Results' not in result:
@@ -41,15 +107,18 @@ def parse_vulnerabilities(result):
                 elif severity == 'LOW':
                     stats['low'] += 1
                 stats['total'] += 1
+        
+        # config 扫描的结果是配置问题而不是漏洞，单独计数
+        stats['misconfigurations'] += len(failed_misconfigurations(res))
     
     return stats
 
 def generate_html_report(task_id):
     """生成 HTML 格式报告"""
-    if task_id not in scan_tasks:
+    task = get_task(task_id)
+    if task is None:
         return None
     
-    task = scan_tasks[task_id]
     if task['status'] != 'completed' or 'result' not in task:
         return None
     
@@ -180,6 +249,10 @@ def generate_html_report(task_id):
             background: #e0e7ff;
         }
         
+        .stat-card.misconfig {
+            background: #f3e8ff;
+        }
+        
         .stat-number {
             font-size: 32px;
             font-weight: 700;
@@ -202,6 +275,10 @@ def generate_html_report(task_id):
             color: #3730a3;
         }
         
+        .stat-card.misconfig .stat-number {
+            color: #6b21a8;
+        }
+        
         .stat-text {
             font-size: 13px;
             color: #6b7280;
@@ -373,6 +450,12 @@ def generate_html_report(task_id):
                     <div class="stat-number">{{ stats.low }}</div>
                     <div class="stat-text">低危漏洞</div>
                 </div>
+                {% if stats.misconfigurations %}
+                <div class="stat-card misconfig">
+                    <div class="stat-number">{{ stats.misconfigurations }}</div>
+                    <div class="stat-text">配置问题</div>
+                </div>
+                {% endif %}
             </div>
         </div>
         
@@ -414,9 +497,40 @@ def generate_html_report(task_id):
                     </div>
                     {% endfor %}
                 </div>
-                {% else %}
+                {% endif %}
+                
+                {% set misconfigs = result.Misconfigurations|default([], true)|rejectattr('Status', 'equalto', 'PASS')|list %}
+                {% if misconfigs %}
+                <div class="vuln-table">
+                    <div class="vuln-row vuln-header">
+                        <div class="vuln-cell">检查项</div>
+                        <div class="vuln-cell">严重程度</div>
+                        <div class="vuln-cell">问题</div>
+                        <div class="vuln-cell">修复建议</div>
+                    </div>
+                    {% for misconf in misconfigs %}
+                    <div class="vuln-row">
+                        <div class="vuln-cell">{{ misconf.AVDID or misconf.ID }}</div>
+                        <div class="vuln-cell">
+                            <span class="severity-badge {{ misconf.Severity|lower }}">
+                                {% if misconf.Severity == 'CRITICAL' %}严重
+                                {% elif misconf.Severity == 'HIGH' %}高危
+                                {% elif misconf.Severity == 'MEDIUM' %}中危
+                                {% elif misconf.Severity == 'LOW' %}低危
+                                {% else %}{{ misconf.Severity }}
+                                {% endif %}
+                            </span>
+                        </div>
+                        <div class="vuln-cell">{{ misconf.Title }}</div>
+                        <div class="vuln-cell">{{ misconf.Resolution }}</div>
+                    </div>
+                    {% endfor %}
+                </div>
+                {% endif %}
+                
+                {% if not result.Vulnerabilities and not misconfigs %}
                 <div class="no-vuln-message">
-                    ✓ 未发现漏洞
+                    ✓ 未发现问题
                 </div>
                 {% endif %}
             </div>
@@ -434,11 +548,11 @@ def generate_html_report(task_id):
     from jinja2 import Template
     template = Template(html_template)
     
-    scan_type_map = {'image': 'Docker 镜像', 'repo': 'GitHub 仓库'}
+    scanner = get_scanner(task['type'])
     
     html = template.render(
         target=task['target'],
-        scan_type=scan_type_map.get(task['type'], task['type']),
+        scan_type=scanner.label if scanner else task['type'],
         report_time=datetime.now().strftime('%Y年%m月%d日 %H:%M:%S'),
         stats=stats,
         results=result.get('Results', [])
@@ -458,10 +572,10 @@ def generate_pdf_report(task_id):
         from reportlab.lib.units import inch
         from reportlab.lib.enums import TA_CENTER, TA_LEFT
         
-        if task_id not in scan_tasks:
+        task = get_task(task_id)
+        if task is None:
             return None
         
-        task = scan_tasks[task_id]
         if task['status'] != 'completed' or 'result' not in task:
             return None
         
@@ -469,8 +583,10 @@ def generate_pdf_report(task_id):
         stats = task.get('stats', {})
         
         pdf_path = os.path.join(SCAN_RESULTS_DIR, f"{task_id}.pdf")
+        # 先写临时文件再改名，避免下载到生成中的半个文件
+        tmp_path = f"{pdf_path}.{threading.get_ident()}.tmp"
         doc = SimpleDocTemplate(
-            pdf_path, 
+            tmp_path, 
             pagesize=A4, 
             topMargin=0.5*inch, 
             bottomMargin=0.5*inch,
@@ -517,7 +633,8 @@ def generate_pdf_report(task_id):
         story.append(Spacer(1, 0.3*inch))
         
         # 基本信息
-        scan_type_text = "Docker Image" if task['type'] == 'image' else "GitHub Repository"
+        scanner = get_scanner(task['type'])
+        scan_type_text = scanner.label_en if scanner else task['type']
         info_data = [
             ['Scan Target', task['target']],
             ['Scan Type', scan_type_text],
@@ -629,8 +746,47 @@ def generate_pdf_report(task_id):
                     story.append(Spacer(1, 0.1*inch))
                     remaining = total_vulns - 40
                     story.append(Paragraph(f"Note: {remaining} more vulnerabilities not shown here", normal_style))
-            else:
-                story.append(Paragraph("No vulnerabilities found", normal_style))
+            
+            misconfigs = failed_misconfigurations(res)
+            if misconfigs:
+                if res.get('Vulnerabilities'):
+                    story.append(Spacer(1, 0.2*inch))
+                story.append(Paragraph(f"Found {len(misconfigs)} misconfigurations", normal_style))
+                story.append(Spacer(1, 0.1*inch))
+                
+                misconf_data = [['Check ID', 'Severity', 'Title']]
+                for misconf in misconfigs[:40]:
+                    misconf_data.append([
+                        (misconf.get('AVDID') or misconf.get('ID', ''))[:20],
+                        misconf.get('Severity', ''),
+                        misconf.get('Title', '')[:60]
+                    ])
+                
+                misconf_table = Table(misconf_data, colWidths=[1.3*inch, 0.8*inch, 3.7*inch])
+                misconf_table.setStyle(TableStyle([
+                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f3f4f6')),
+                    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+                    ('FONTSIZE', (0, 0), (-1, 0), 9),
+                    ('FONTSIZE', (0, 1), (-1, -1), 8),
+                    ('LEADING', (0, 0), (-1, -1), 12),
+                    ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#e5e7eb')),
+                    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+                    ('LEFTPADDING', (0, 0), (-1, -1), 8),
+                    ('RIGHTPADDING', (0, 0), (-1, -1), 8),
+                    ('TOPPADDING', (0, 0), (-1, -1), 7),
+                    ('BOTTOMPADDING', (0, 0), (-1, -1), 7),
+                    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#fafafa')]),
+                ]))
+                story.append(misconf_table)
+                
+                if len(misconfigs) > 40:
+                    story.append(Spacer(1, 0.1*inch))
+                    story.append(Paragraph(f"Note: {len(misconfigs) - 40} more misconfigurations not shown here", normal_style))
+            
+            if not res.get('Vulnerabilities') and not misconfigs:
+                story.append(Paragraph("No issues found", normal_style))
             
             story.append(Spacer(1, 0.3*inch))
         
@@ -652,6 +808,7 @@ def generate_pdf_report(task_id):
         
         # 生成 PDF
         doc.build(story)
+        os.replace(tmp_path, pdf_path)
         print(f"[{task_id}] PDF 报告已生成: {pdf_path}")
         return pdf_path
         
@@ -660,42 +817,187 @@ def generate_pdf_report(task_id):
         traceback.print_exc()
         return None
 
+def evaluate_verdict(task, scan_result):
+    """按任务的策略求值；求值出错时判定为不通过并记录原因，不影响扫描本身的结果"""
+    try:
+        return compile_policy(task.get('policy')).evaluate(build_index(scan_result))
+    except Exception as e:
+        print(f"[{task['id']}] 策略求值失败: {e}")
+        return {'pass': False, 'violations': [], 'violation_count': 0, 'error': f'策略求值失败: {e}'}
+
+def run_trivy(task_id, cmd, options, output_file, expose_stderr=True):
+    """
+    执行一条 trivy 命令，输出文件无效时抛出异常
+
+    本地路径类扫描的 stderr 可能包含服务端文件内容或目录结构，只写入服务日志，不返回给调用方。
+    """
+    print(f"[{task_id}] 执行命令: {' '.join(cmd)}")
+    
+    result = subprocess.run(
+        cmd, 
+        capture_output=True, 
+        text=True, 
+        timeout=scan_timeout(options) + 30,
+        cwd='/tmp'
+    )
+    
+    if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+        if not expose_stderr:
+            print(f"[{task_id}] trivy 错误输出: {result.stderr}")
+            raise Exception("扫描未生成有效输出文件，详见服务日志")
+        raise Exception(f"扫描未生成有效输出文件。错误: {result.stderr}")
+
+def pull_image(task_id, target):
+    """
+    把镜像拉取到本地 blob 缓存并生成 OCI 布局目录，返回 (布局目录, 镜像摘要)
+
+    未启用缓存或拉取失败时返回 (None, None)，由 trivy 直接从仓库拉取。
+    """
+    if blob_cache is None:
+        return None, None
+    
+    try:
+        layout_dir, digest = blob_cache.prepare_layout(target, task_id)
+    except (RegistryError, OSError, ValueError, KeyError) as e:
+        print(f"[{task_id}] 从本地缓存准备镜像失败，改由 trivy 直接拉取: {e}")
+        return None, None
+    
+    print(f"[{task_id}] 镜像已就绪: {digest}")
+    return layout_dir, digest
+
+def release_image(layout_dir):
+    if layout_dir:
+        blob_cache.release(layout_dir)
+
+def prepare_image_sbom(task_id, target, options):
+    """
+    获取镜像扫描使用的 SBOM
+    
+    重扫任务直接使用已保存的 SBOM；其他任务先向仓库查询镜像摘要，
+    已有相同摘要和分析选项的 SBOM 时直接复用，否则拉取镜像生成一份并保存。
+    返回 (SBOM 路径, 是否为需要清理的临时文件)。
+    """
+    task = scan_tasks[task_id]
+    if task.get('sbom_digest'):
+        sbom_file = sbom_store.lookup(task['sbom_digest'], options)
+        if sbom_file:
+            print(f"[{task_id}] 使用已保存的 SBOM: {task['sbom_digest']}")
+            return sbom_file, False
+    
+    digest = None
+    try:
+        digest = resolve_digest(target)
+    except RegistryError as e:
+        print(f"[{task_id}] 查询镜像摘要失败，拉取镜像生成 SBOM: {e}")
+    
+    if digest:
+        sbom_file = sbom_store.lookup(digest, options)
+        if sbom_file:
+            print(f"[{task_id}] 镜像 {digest} 已有 SBOM，不再拉取镜像")
+            sbom_store.record_target(target, digest, options)
+            task['sbom_digest'] = digest
+            return sbom_file, False
+    
+    tmp_file = sbom_store.temp_path(task_id)
+    layout_dir, image_digest = pull_image(task_id, target)
+    try:
+        run_trivy(task_id, build_sbom_command(target, options, tmp_file, input_dir=layout_dir), options, tmp_file)
+    finally:
+        release_image(layout_dir)
+    
+    digest, sbom_file = sbom_store.store(target, tmp_file, options, digest=image_digest or digest)
+    if digest is None:
+        print(f"[{task_id}] 无法识别镜像摘要，SBOM 不保存")
+        return sbom_file, True
+    
+    task['sbom_digest'] = digest
+    return sbom_file, False
+
+def restore_artifact(output_file, target, artifact_type, metadata=None):
+    """trivy 实际扫描的是临时文件 / 目录时，把报告中的扫描对象改回请求的目标"""
+    with open(output_file, 'r') as f:
+        report = json.load(f)
+    report['ArtifactName'] = target
+    report['ArtifactType'] = artifact_type
+    if metadata:
+        report.setdefault('Metadata', {}).update(metadata)
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+def run_repo_scan(task_id, target, options, output_file):
+    """
+    通过本地仓库镜像扫描：增量 fetch 后检出请求的提交，用 trivy fs 扫描
+
+    同一提交已有扫描结果时直接复用。返回 False 表示镜像不可用，需改用 trivy repo。
+    """
+    try:
+        sha = repo_cache.resolve(target, options)
+    except RefNotFound:
+        raise
+    except RepoError as e:
+        print(f"[{task_id}] 更新仓库镜像失败，改由 trivy 直接克隆: {e}")
+        return False
+    
+    scan_tasks[task_id]['commit'] = sha
+    if repo_cache.load_result(sha, options, output_file):
+        print(f"[{task_id}] 提交 {sha[:12]} 已有扫描结果，直接复用")
+    else:
+        worktree = repo_cache.checkout(target, sha, task_id)
+        try:
+            fs_options = {k: v for k, v in options.items() if k not in ('branch', 'tag', 'commit')}
+            run_trivy(task_id, build_command('fs', worktree, fs_options, output_file), options, output_file)
+        finally:
+            repo_cache.release(target, worktree)
+    
+    # worktree 路径是临时的，缓存结果也可能来自同一提交的其他地址
+    restore_artifact(output_file, target, 'repository', {'RepoURL': target, 'Commit': sha})
+    
+    repo_cache.save_result(sha, options, output_file)
+    return True
+
 def run_trivy_scan(task_id, scan_type, target, options):
     """执行 Trivy 扫描"""
     output_file = os.path.join(SCAN_RESULTS_DIR, f"{task_id}.json")
+    temp_sbom = None
+    layout_dir = None
     
     try:
         scan_tasks[task_id]['status'] = 'running'
         scan_tasks[task_id]['started_at'] = datetime.now().isoformat()
         
-        if scan_type == 'image':
-            cmd = ['trivy', 'image', '--format', 'json', '--output', output_file, target]
+        if scan_type == 'repo' and repo_cache is not None and run_repo_scan(task_id, target, options, output_file):
+            # 已通过本地仓库镜像完成扫描
+            cmd = None
+        elif scan_type == 'image' and sbom_store.SBOM_FIRST and sbom_store.supports(options):
+            # 镜像只分析一次生成 SBOM，漏洞匹配在 SBOM 上进行
+            sbom_file, is_temp = prepare_image_sbom(task_id, target, options)
+            if is_temp:
+                temp_sbom = sbom_file
+            sbom_options = {k: v for k, v in options.items() if k in sbom_store.SBOM_SCAN_OPTIONS}
+            run_trivy(task_id, build_command('sbom', sbom_file, sbom_options, output_file), options, output_file)
+            restore_artifact(output_file, target, 'container_image')
+            cmd = None
+        elif scan_type == 'image':
+            layout_dir, _ = pull_image(task_id, target)
+            cmd = build_command(scan_type, target, options, output_file, input_dir=layout_dir)
         else:
-            cmd = ['trivy', 'repo', '--format', 'json', '--output', output_file, target]
-        
-        cmd.extend(['--severity', 'CRITICAL,HIGH,MEDIUM,LOW'])
-        cmd.extend(['--timeout', '10m'])
+            cmd = build_command(scan_type, target, options, output_file)
         
-        print(f"[{task_id}] 执行命令: {' '.join(cmd)}")
-        
-        result = subprocess.run(
-            cmd, 
-            capture_output=True, 
-            text=True, 
-            timeout=600,
-            cwd='/tmp'
-        )
-        
-        if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
-            raise Exception(f"扫描未生成有效输出文件。错误: {result.stderr}")
+        if cmd is not None:
+            run_trivy(task_id, cmd, options, output_file, expose_stderr=not local_target(scan_type, target))
+            if layout_dir:
+                restore_artifact(output_file, target, 'container_image')
         
         with open(output_file, 'r') as f:
             scan_result = json.load(f)
         
         stats = parse_vulnerabilities(scan_result)
+        verdict = evaluate_verdict(scan_tasks[task_id], scan_result)
         
+        scan_tasks[task_id]['verdict'] = verdict
         scan_tasks[task_id]['status'] = 'completed'
         scan_tasks[task_id]['result'] = scan_result
+        scan_tasks[task_id]['report_digest'] = file_digest(output_file)
         scan_tasks[task_id]['stats'] = stats
         scan_tasks[task_id]['completed_at'] = datetime.now().isoformat()
         
@@ -707,6 +1009,10 @@ def run_trivy_scan(task_id, scan_type, target, options):
                 f.write(html_content)
             print(f"[{task_id}] HTML 报告已生成")
         
+        # 预压缩报告，下载时直接发送 .gz / .br 文件
+        precompress(output_file)
+        precompress(html_path)
+        
         # 后台生成 PDF（不阻塞）
         def generate_pdf_async():
             try:
@@ -726,6 +1032,16 @@ def run_trivy_scan(task_id, scan_type, target, options):
         scan_tasks[task_id]['status'] = 'failed'
         scan_tasks[task_id]['error'] = error_msg
         scan_tasks[task_id]['completed_at'] = datetime.now().isoformat()
+    
+    finally:
+        if temp_sbom and os.path.exists(temp_sbom):
+            os.remove(temp_sbom)
+        release_image(layout_dir)
+
+def run_scan_task(task_id, scan_type, target, options):
+    """本地线程模式下执行扫描并投递回调"""
+    run_trivy_scan(task_id, scan_type, target, options)
+    notify_completion(task_id)
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -749,46 +1065,163 @@ def health_check():
         'service': 'trivy-scanner',
         'trivy_version': trivy_version,
         'pdf_support': pdf_available,
-        'tasks_count': len(scan_tasks)
+        'tasks_count': task_queue.count() if task_queue else len(scan_tasks),
+        'queue': {'mode': 'shared', 'depth': task_queue.depth()} if task_queue else {'mode': 'local'},
+        'webhooks': webhook_dispatcher.get_stats(),
+        'scheduler': scheduler.get_stats(),
+        'blob_cache': blob_cache.get_stats() if blob_cache else {'enabled': False},
+        'repo_cache': repo_cache.get_stats() if repo_cache else {'enabled': False}
     })
 
-@app.route('/api/scan', methods=['POST'])
-def create_scan():
-    """创建扫描任务"""
-    data = request.json
+def validate_scan_request(data):
+    """校验单个扫描请求，返回错误信息或 None"""
+    if not isinstance(data, dict):
+        return '请求格式错误'
     
     scan_type = data.get('type')
     target = data.get('target')
     
     if not target or not scan_type:
-        return jsonify({'error': '目标和类型不能为空'}), 400
+        return '目标和类型不能为空'
     
-    if scan_type not in ['image', 'repo']:
-        return jsonify({'error': '扫描类型必须是 image 或 repo'}), 400
+    if scan_type not in SCANNER_TYPES:
+        return f"扫描类型必须是 {', '.join(SCANNER_TYPES)} 之一"
     
+    error = validate_target(scan_type, target)
+    if error:
+        return error
+    
+    try:
+        options = validate_options(scan_type, data.get('options'))
+    except ValueError as e:
+        return f"选项无效: {e}"
+    
+    if data.get('callback_url') is not None:
+        error = validate_callback_url(data['callback_url'])
+        if error:
+            return error
+    
+    try:
+        policy = compile_policy(data.get('policy'))
+    except ValueError as e:
+        return f"策略无效: {e}"
+    try:
+        policy.check_options(options)
+    except ValueError as e:
+        return f"扫描选项与策略冲突: {e}"
+    
+    return None
+
+def submit_scan(scan_type, target, options=None, callback_url=None, batch_id=None, policy=None,
+                extra=None, executor=None):
+    """
+    创建任务并交给本地线程或共享队列执行，返回任务 ID
+    
+    extra 中的字段直接写入任务；executor 指定本地模式下使用的线程池。
+    """
     task_id = str(uuid.uuid4())
+    options = validate_options(scan_type, options)
     
-    scan_tasks[task_id] = {
+    task = {
         'id': task_id,
         'type': scan_type,
         'target': target,
+        'options': options,
         'status': 'pending',
         'created_at': datetime.now().isoformat()
     }
+    if callback_url:
+        task['callback_url'] = callback_url
+    if batch_id:
+        task['batch_id'] = batch_id
+    if policy:
+        task['policy'] = policy
+    if extra:
+        task.update(extra)
+    
+    if task_queue is not None:
+        task_queue.enqueue(task)
+    elif executor is not None:
+        scan_tasks[task_id] = task
+        executor.submit(run_scan_task, task_id, scan_type, target, options)
+    else:
+        scan_tasks[task_id] = task
+        thread = threading.Thread(target=run_scan_task, args=(task_id, scan_type, target, options))
+        thread.daemon = True
+        thread.start()
     
-    thread = threading.Thread(target=run_trivy_scan, args=(task_id, scan_type, target, {}))
-    thread.daemon = True
-    thread.start()
+    return task_id
+
+@app.route('/api/scan', methods=['POST'])
+def create_scan():
+    """创建扫描任务"""
+    data = request.json
+    
+    error = validate_scan_request(data)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    task_id = submit_scan(data['type'], data['target'], data.get('options'), data.get('callback_url'),
+                          policy=data.get('policy'))
     
     return jsonify({'task_id': task_id, 'status': 'pending'}), 202
 
+@app.route('/api/scan/batch', methods=['POST'])
+def create_scan_batch():
+    """批量创建扫描任务，可为整批指定一个 callback_url"""
+    data = request.json
+    
+    if not isinstance(data, dict) or not isinstance(data.get('scans'), list) or not data['scans']:
+        return jsonify({'error': 'scans 必须是非空列表'}), 400
+    
+    callback_url = data.get('callback_url')
+    if callback_url is not None:
+        error = validate_callback_url(callback_url)
+        if error:
+            return jsonify({'error': error}), 400
+    
+    policy = data.get('policy')
+    if policy is not None:
+        try:
+            compile_policy(policy)
+        except ValueError as e:
+            return jsonify({'error': f"策略无效: {e}"}), 400
+    
+    for idx, item in enumerate(data['scans']):
+        # 未单独指定策略的扫描按整批策略校验选项
+        if isinstance(item, dict) and policy is not None and item.get('policy') is None:
+            item = dict(item, policy=policy)
+        error = validate_scan_request(item)
+        if error:
+            return jsonify({'error': f"scans[{idx}]: {error}"}), 400
+    
+    batch_id = str(uuid.uuid4())
+    task_ids = [
+        submit_scan(item['type'], item['target'], item.get('options'), item.get('callback_url') or callback_url,
+                    batch_id, item.get('policy') or policy)
+        for item in data['scans']
+    ]
+    
+    return jsonify({'batch_id': batch_id, 'task_ids': task_ids, 'status': 'pending'}), 202
+
 @app.route('/api/scan/<task_id>', methods=['GET'])
 def get_scan_status(task_id):
     """获取扫描状态"""
-    if task_id not in scan_tasks:
+    task = get_task(task_id)
+    if task is None:
         return jsonify({'error': '任务不存在'}), 404
     
-    task = scan_tasks[task_id]
+    # 已完成任务以报告摘要为 ETag，内容不再变化；其余按响应体计算（不含报告，开销很小），轮询时返回 304。
+    # 队列模式下结果文件暂时读不到时响应中没有 result，不能当作最终内容缓存
+    if task['status'] == 'completed' and task.get('report_digest') and 'result' in task:
+        etag = task_etag(task, ('id', 'report_digest'))
+        return send_json(lambda: build_status_response(task), etag, immutable=True)
+    
+    response = build_status_response(task)
+    return send_json(lambda: response, payload_etag(response), immutable=task['status'] == 'failed')
+
+def build_status_response(task):
+    """构造状态接口的响应体"""
     response = {
         'task_id': task['id'],
         'type': task['type'],
@@ -797,41 +1230,194 @@ def get_scan_status(task_id):
         'created_at': task['created_at']
     }
     
+    if task.get('options'):
+        response['options'] = task['options']
     if 'started_at' in task:
         response['started_at'] = task['started_at']
     if 'completed_at' in task:
         response['completed_at'] = task['completed_at']
     if 'error' in task:
         response['error'] = task['error']
+    if 'batch_id' in task:
+        response['batch_id'] = task['batch_id']
+    if 'sbom_digest' in task:
+        response['sbom_digest'] = task['sbom_digest']
+    if 'commit' in task:
+        response['commit'] = task['commit']
+    if 'rescan_of' in task:
+        response['rescan_of'] = task['rescan_of']
+    if 'schedule' in task:
+        response['schedule'] = task['schedule']
     if 'stats' in task:
         response['stats'] = task['stats']
+    if 'verdict' in task:
+        response['verdict'] = {'pass': task['verdict']['pass'], 'violation_count': task['verdict']['violation_count']}
     if task['status'] == 'completed' and 'result' in task:
         response['result'] = task['result']
     
+    return response
+
+@app.route('/api/scan/<task_id>/rescan', methods=['POST'])
+def rescan(task_id):
+    """基于已保存的 SBOM 重新扫描镜像（不重新拉取镜像）"""
+    task = get_task(task_id)
+    if task is None:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    if task['type'] != 'image' or not task.get('sbom_digest') \
+            or not sbom_store.lookup(task['sbom_digest'], task.get('options')):
+        return jsonify({'error': '该任务没有可用的 SBOM'}), 400
+    
+    data = request.get_json(silent=True) or {}
+    callback_url = data.get('callback_url')
+    if callback_url is not None:
+        error = validate_callback_url(callback_url)
+        if error:
+            return jsonify({'error': error}), 400
+    
+    new_task_id = submit_scan(
+        'image', task['target'], task.get('options'), callback_url,
+        policy=task.get('policy'),
+        extra={'sbom_digest': task['sbom_digest'], 'rescan_of': task_id}
+    )
+    
+    return jsonify({'task_id': new_task_id, 'status': 'pending'}), 202
+
+@app.route('/api/sboms', methods=['GET'])
+def list_sboms():
+    """列出已保存 SBOM 的镜像"""
+    return jsonify({'sboms': sbom_store.list_targets()})
+
+@app.route('/api/sboms/rescan', methods=['POST'])
+def rescan_all_sboms():
+    """漏洞库更新后批量重扫所有已保存 SBOM 的镜像"""
+    data = request.get_json(silent=True) or {}
+    
+    callback_url = data.get('callback_url')
+    if callback_url is not None:
+        error = validate_callback_url(callback_url)
+        if error:
+            return jsonify({'error': error}), 400
+    
+    try:
+        options = validate_options('image', data.get('options'))
+        policy = data.get('policy')
+        compile_policy(policy).check_options(options)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    batch_id = str(uuid.uuid4())
+    task_ids = [
+        submit_scan(
+            'image', record['target'], {**record.get('analysis', {}), **options, 'scanners': ['vuln']},
+            callback_url, batch_id, policy,
+            extra={'sbom_digest': record['digest']},
+            executor=rescan_pool
+        )
+        for record in sbom_store.list_targets()
+    ]
+    
+    return jsonify({'batch_id': batch_id, 'task_ids': task_ids, 'count': len(task_ids)}), 202
+
+def submit_scheduled_scan(spec, target, extra):
+    """定时计划提交扫描"""
+    return submit_scan(spec.get('type', 'image'), target, spec.get('options'), spec.get('callback_url'),
+                       policy=spec.get('policy'), extra=extra)
+
+scheduler = Scheduler(
+    submit=submit_scheduled_scan,
+    get_task=get_task,
+    schedules_file=os.environ.get('SCHEDULES_FILE', os.path.join(SCAN_RESULTS_DIR, 'schedules.json')),
+    state_file=os.path.join(SCAN_RESULTS_DIR, 'schedule_state.json')
+)
+
+@app.route('/api/schedules', methods=['GET'])
+def list_schedules():
+    """列出定时计划"""
+    return jsonify({'schedules': scheduler.list()})
+
+@app.route('/api/schedules', methods=['POST'])
+def put_schedule():
+    """创建或替换定时计划（按 name）"""
+    data = request.json
+    
+    error = validate_schedule(data, validate_scan_request)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    scheduler.put(data)
+    return jsonify({'name': data['name']}), 201
+
+@app.route('/api/schedules/<name>', methods=['DELETE'])
+def delete_schedule(name):
+    """删除定时计划"""
+    if not scheduler.remove(name):
+        return jsonify({'error': '计划不存在'}), 404
+    return jsonify({'name': name})
+
+@app.route('/api/schedules/<name>/run', methods=['POST'])
+def run_schedule(name):
+    """立即触发一次定时计划（仍按窗口分散、按仓库限流）"""
+    count = scheduler.trigger(name)
+    if not count:
+        return jsonify({'error': '计划不存在'}), 404
+    return jsonify({'name': name, 'targets': count}), 202
+
+@app.route('/api/scan/<task_id>/verdict', methods=['GET'])
+def get_scan_verdict(task_id):
+    """获取策略判定结果（通过 / 不通过及违规 CVE），不传输完整报告"""
+    task = get_task(task_id)
+    if task is None:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    if task['status'] in ('pending', 'running'):
+        return jsonify({'task_id': task_id, 'status': task['status']}), 202
+    
+    if task['status'] == 'failed':
+        return jsonify({'task_id': task_id, 'status': 'failed', 'pass': False, 'error': task.get('error')})
+    
+    verdict = task.get('verdict')
+    if verdict is None:
+        # 旧任务没有预先计算的判定结果，按当时的策略补算一次
+        verdict = evaluate_verdict(task, task.get('result'))
+        task['verdict'] = verdict
+    
+    response = {
+        'task_id': task_id,
+        'status': 'completed',
+        'pass': verdict['pass'],
+        'violations': verdict['violations'],
+        'violation_count': verdict['violation_count']
+    }
+    if 'error' in verdict:
+        response['error'] = verdict['error']
     return jsonify(response)
 
 @app.route('/api/scan/<task_id>/report/json', methods=['GET'])
 def download_json_report(task_id):
     """下载 JSON 报告"""
-    if task_id not in scan_tasks:
+    task = get_task(task_id)
+    if task is None:
         return jsonify({'error': '任务不存在'}), 404
     
-    if scan_tasks[task_id]['status'] != 'completed':
+    if task['status'] != 'completed':
         return jsonify({'error': '扫描尚未完成'}), 400
     
     report_file = os.path.join(SCAN_RESULTS_DIR, f"{task_id}.json")
     if not os.path.exists(report_file):
         return jsonify({'error': '报告文件不存在'}), 404
     
-    return send_file(report_file, as_attachment=True, download_name=f"scan-report-{task_id}.json")
+    return send_report_file(report_file, 'application/json', immutable=True,
+                            download_name=f"scan-report-{task_id}.json")
 
 @app.route('/api/scan/<task_id>/report/html', methods=['GET'])
 def view_html_report(task_id):
     """查看 HTML 报告"""
-    if task_id not in scan_tasks:
+    task = get_task(task_id)
+    if task is None:
         return "任务不存在", 404
     
-    if scan_tasks[task_id]['status'] != 'completed':
+    if task['status'] != 'completed':
         return "扫描尚未完成", 400
     
     html_file = os.path.join(SCAN_RESULTS_DIR, f"{task_id}.html")
@@ -842,17 +1428,18 @@ def view_html_report(task_id):
             return "无法生成报告", 500
         with open(html_file, 'w', encoding='utf-8') as f:
             f.write(html_content)
+        remove_variants(html_file)
     
-    with open(html_file, 'r', encoding='utf-8') as f:
-        return f.read()
+    return send_report_file(html_file, 'text/html', immutable=True)
 
 @app.route('/api/scan/<task_id>/report/pdf', methods=['GET'])
 def download_pdf_report(task_id):
     """下载 PDF 报告"""
-    if task_id not in scan_tasks:
+    task = get_task(task_id)
+    if task is None:
         return jsonify({'error': '任务不存在'}), 404
     
-    if scan_tasks[task_id]['status'] != 'completed':
+    if task['status'] != 'completed':
         return jsonify({'error': '扫描尚未完成'}), 400
     
     pdf_file = os.path.join(SCAN_RESULTS_DIR, f"{task_id}.pdf")
@@ -862,13 +1449,14 @@ def download_pdf_report(task_id):
         if not pdf_path:
             return jsonify({'error': 'PDF 生成失败'}), 500
     
-    return send_file(pdf_file, as_attachment=True, download_name=f"scan-report-{task_id}.pdf")
+    return send_report_file(pdf_file, 'application/pdf', immutable=True,
+                            download_name=f"scan-report-{task_id}.pdf")
 
 @app.route('/api/scans', methods=['GET'])
 def list_scans():
     """列出所有扫描"""
     scans = []
-    for task_id, task in scan_tasks.items():
+    for task in list_tasks():
         scan_info = {
             'task_id': task['id'],
             'type': task['type'],
@@ -888,4 +1476,6 @@ def list_scans():
 if __name__ == '__main__':
     os.makedirs(SCAN_RESULTS_DIR, exist_ok=True)
     print(f"扫描结果目录: {SCAN_RESULTS_DIR}")
+    if os.environ.get('SCHEDULER_ENABLED', '1') not in ('0', 'false', 'no'):
+        scheduler.start()
     app.run(host='0.0.0.0', port=8000, debug=False)
\ No newline at end of file
@@ -0,0 +1,386 @@
+# backend/benchmark.py
+"""
+服务自身开销的压测脚本
+
+用 fake_trivy.py 替换真实的 trivy，排除扫描器与网络的影响，
+在独立子进程中启动后端，按指定并发驱动完整的扫描流程：
+
+    POST /api/scan -> 轮询 GET /api/scan/<id> -> 下载 JSON / HTML 报告
+
+并统计吞吐量、各接口 p50/p99 延迟，以及 API 进程和各 worker 进程（--workers）的
+峰值 RSS、文件描述符数和线程数。结果写入 JSON 文件，便于多次运行之间对比。
+
+示例:
+    python benchmark.py --scans 200 --concurrency 16 --vulns 200 --output bench.json
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SERVER_CODE = (
+    "import sys\n"
+    "from werkzeug.serving import run_simple\n"
+    "from app import app\n"
+    "run_simple(sys.argv[1], int(sys.argv[2]), app, threaded=True)\n"
+)
+
+def percentile(values, pct):
+    """最近秩法百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+def summarize(values):
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(max(values) * 1000, 3)
+    }
+
+class ProcessSampler(threading.Thread):
+    """周期性采样服务进程的资源占用（依赖 /proc，仅 Linux）"""
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.peak = {'rss_kb': 0, 'hwm_kb': 0, 'threads': 0, 'open_files': 0}
+        self.available = os.path.isdir(f"/proc/{pid}")
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key == 'VmRSS':
+                        self.peak['rss_kb'] = max(self.peak['rss_kb'], int(value.split()[0]))
+                    elif key == 'VmHWM':
+                        self.peak['hwm_kb'] = max(self.peak['hwm_kb'], int(value.split()[0]))
+                    elif key == 'Threads':
+                        self.peak['threads'] = max(self.peak['threads'], int(value))
+            open_files = len(os.listdir(f"/proc/{self.pid}/fd"))
+            self.peak['open_files'] = max(self.peak['open_files'], open_files)
+        except (OSError, ValueError):
+            pass
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.sample()
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        self.sample()
+
+    def report(self):
+        if not self.available:
+            return None
+        return {
+            'peak_rss_mb': round(max(self.peak['rss_kb'], self.peak['hwm_kb']) / 1024, 2),
+            'peak_threads': self.peak['threads'],
+            'peak_open_files': self.peak['open_files']
+        }
+
+class Client:
+    """每个压测线程持有一个连接，记录各接口耗时"""
+
+    def __init__(self, host, port, recorder):
+        self.host = host
+        self.port = port
+        self.recorder = recorder
+        self.local = threading.local()
+
+    def conn(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        return self.local.conn
+
+    def request(self, label, method, path, body=None):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        start = time.perf_counter()
+        try:
+            conn = self.conn()
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            self.local.conn.close()
+            del self.local.conn
+            self.recorder.error(label)
+            raise
+        self.recorder.add(label, time.perf_counter() - start, status, len(data))
+        return status, data
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.bytes = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def add(self, label, elapsed, status, size):
+        with self.lock:
+            self.latencies[label].append(elapsed)
+            self.statuses[label][str(status)] += 1
+            self.bytes[label] += size
+
+    def error(self, label):
+        with self.lock:
+            self.errors[label] += 1
+
+    def total_requests(self):
+        return sum(len(v) for v in self.latencies.values())
+
+def run_one_scan(client, index, args):
+    """执行一次完整扫描流程，返回 (是否成功, 端到端耗时)"""
+    start = time.perf_counter()
+    target = f"bench/image-{index % args.distinct_targets}:latest"
+    status, data = client.request('POST /api/scan', 'POST', '/api/scan',
+                                  {'type': 'image', 'target': target})
+    if status != 202:
+        return False, time.perf_counter() - start
+
+    task_id = json.loads(data)['task_id']
+    deadline = time.time() + args.scan_timeout
+    state = 'pending'
+    while time.time() < deadline:
+        status, data = client.request('GET /api/scan/<id>', 'GET', f"/api/scan/{task_id}")
+        state = json.loads(data).get('status')
+        if state in ('completed', 'failed'):
+            break
+        time.sleep(args.poll_interval)
+
+    if state != 'completed':
+        return False, time.perf_counter() - start
+
+    client.request('GET /api/scan/<id>/report/json', 'GET', f"/api/scan/{task_id}/report/json")
+    client.request('GET /api/scan/<id>/report/html', 'GET', f"/api/scan/{task_id}/report/html")
+    if index % args.list_every == 0:
+        client.request('GET /api/scans', 'GET', '/api/scans')
+
+    return True, time.perf_counter() - start
+
+def wait_for_server(client, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"服务进程已退出，返回码 {proc.returncode}")
+        try:
+            status, _ = client.request('GET /api/health', 'GET', '/api/health')
+            if status == 200:
+                return
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.2)
+    raise RuntimeError('等待服务启动超时')
+
+def make_stub_bin(work_dir):
+    """生成名为 trivy 的包装脚本，指向 fake_trivy.py"""
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    stub = os.path.join(bin_dir, 'trivy')
+    with open(stub, 'w') as f:
+        f.write('#!/bin/sh\n')
+        f.write(f'exec "{sys.executable}" "{os.path.join(BACKEND_DIR, "fake_trivy.py")}" "$@"\n')
+    os.chmod(stub, 0o755)
+    return bin_dir
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='trivy-bench-')
+    results_dir = os.path.join(work_dir, 'scan_results')
+    os.makedirs(results_dir)
+
+    env = dict(os.environ)
+    env['PATH'] = make_stub_bin(work_dir) + os.pathsep + env.get('PATH', '')
+    env['SCAN_RESULTS_DIR'] = results_dir
+    env['PYTHONUNBUFFERED'] = '1'
+    env['FAKE_TRIVY_RESULTS'] = str(args.results)
+    env['FAKE_TRIVY_VULNS'] = str(args.vulns)
+    env['FAKE_TRIVY_LATENCY'] = str(args.latency)
+    env['FAKE_TRIVY_JITTER'] = str(args.jitter)
+    env['FAKE_TRIVY_FAIL_RATE'] = str(args.fail_rate)
+
+    if args.workers:
+        env['QUEUE_URL'] = f"sqlite:///{os.path.join(work_dir, 'queue.db')}"
+        env['WORKER_CONCURRENCY'] = str(args.worker_concurrency)
+        env['WORKER_POLL_SECONDS'] = '0.1'
+
+    log_path = os.path.join(work_dir, 'server.log')
+    log_file = open(log_path, 'w')
+    proc = subprocess.Popen(
+        [sys.executable, '-c', SERVER_CODE, args.host, str(args.port)],
+        cwd=BACKEND_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+    workers = [
+        subprocess.Popen([sys.executable, 'worker.py'], cwd=BACKEND_DIR, env=env,
+                         stdout=log_file, stderr=subprocess.STDOUT)
+        for _ in range(args.workers)
+    ]
+
+    recorder = Recorder()
+    client = Client(args.host, args.port, recorder)
+    try:
+        wait_for_server(client, proc)
+        recorder = Recorder()
+        client.recorder = recorder
+
+        sampler = ProcessSampler(proc.pid)
+        worker_samplers = [ProcessSampler(p.pid) for p in workers]
+        for s in [sampler] + worker_samplers:
+            s.start()
+
+        scan_latencies = []
+        succeeded = 0
+        failed = 0
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(run_one_scan, client, i, args) for i in range(args.scans)]
+            for future in as_completed(futures):
+                try:
+                    ok, elapsed = future.result()
+                except (OSError, http.client.HTTPException, ValueError):
+                    ok, elapsed = False, None
+                if ok:
+                    succeeded += 1
+                    scan_latencies.append(elapsed)
+                else:
+                    failed += 1
+        duration = time.perf_counter() - started
+        for s in [sampler] + worker_samplers:
+            s.stop()
+    finally:
+        for p in [proc] + workers:
+            p.terminate()
+        for p in [proc] + workers:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        log_file.close()
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'host': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'config': {
+            'scans': args.scans,
+            'concurrency': args.concurrency,
+            'results_per_report': args.results,
+            'vulns_per_result': args.vulns,
+            'trivy_latency_s': args.latency,
+            'trivy_jitter': args.jitter,
+            'fail_rate': args.fail_rate,
+            'poll_interval_s': args.poll_interval,
+            'distinct_targets': args.distinct_targets,
+            'workers': args.workers,
+            'worker_concurrency': args.worker_concurrency if args.workers else None
+        },
+        'duration_s': round(duration, 3),
+        'scans': {
+            'succeeded': succeeded,
+            'failed': failed,
+            'throughput_per_s': round(succeeded / duration, 3) if duration else None,
+            'end_to_end': summarize(scan_latencies)
+        },
+        'requests': {
+            'total': recorder.total_requests(),
+            'throughput_per_s': round(recorder.total_requests() / duration, 3) if duration else None
+        },
+        'endpoints': {
+            label: dict(summarize(values),
+                        statuses=dict(recorder.statuses[label]),
+                        bytes=recorder.bytes[label],
+                        errors=recorder.errors.get(label, 0))
+            for label, values in sorted(recorder.latencies.items())
+        },
+        'process': sampler.report(),
+        'worker_processes': [s.report() for s in worker_samplers]
+    }
+
+    if args.keep:
+        report['work_dir'] = work_dir
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return report
+
+def print_summary(report):
+    scans = report['scans']
+    print(f"扫描: 成功 {scans['succeeded']} / 失败 {scans['failed']}，"
+          f"耗时 {report['duration_s']}s，吞吐 {scans['throughput_per_s']} 次/秒")
+    print(f"请求: {report['requests']['total']} 次，吞吐 {report['requests']['throughput_per_s']} 次/秒")
+    print(f"{'接口':<34}{'次数':>8}{'p50(ms)':>12}{'p99(ms)':>12}")
+    for label, stats in report['endpoints'].items():
+        print(f"{label:<36}{stats['count']:>8}{stats.get('p50_ms', '-'):>12}{stats.get('p99_ms', '-'):>12}")
+    if report['process']:
+        proc = report['process']
+        print(f"API 进程: 峰值 RSS {proc['peak_rss_mb']} MB，"
+              f"峰值线程 {proc['peak_threads']}，峰值文件描述符 {proc['peak_open_files']}")
+    for i, proc in enumerate(report['worker_processes']):
+        if proc:
+            print(f"worker {i}: 峰值 RSS {proc['peak_rss_mb']} MB，"
+                  f"峰值线程 {proc['peak_threads']}，峰值文件描述符 {proc['peak_open_files']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Trivy 扫描服务压测（使用 fake trivy）')
+    parser.add_argument('--scans', type=int, default=50, help='扫描任务总数')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发客户端数')
+    parser.add_argument('--results', type=int, default=3, help='每份报告的 Result 数量')
+    parser.add_argument('--vulns', type=int, default=50, help='每个 Result 的漏洞数量')
+    parser.add_argument('--latency', type=float, default=0.5, help='模拟 trivy 单次扫描耗时（秒）')
+    parser.add_argument('--jitter', type=float, default=0.2, help='扫描耗时抖动比例')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='模拟扫描失败概率')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='状态轮询间隔（秒）')
+    parser.add_argument('--scan-timeout', type=float, default=120, help='单个任务最长等待时间（秒）')
+    parser.add_argument('--distinct-targets', type=int, default=10, help='不同扫描目标的数量')
+    parser.add_argument('--list-every', type=int, default=10, help='每 N 次扫描请求一次任务列表')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker 进程数；大于 0 时使用 SQLite 共享队列模式')
+    parser.add_argument('--worker-concurrency', type=int, default=4, help='每个 worker 的并发扫描数')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--output', default='bench-result.json', help='结果输出文件')
+    parser.add_argument('--keep', action='store_true', help='保留临时目录（含服务日志与报告）')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run_benchmark(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print_summary(report)
+    print(f"结果已写入 {args.output}")
+    return 0 if report['scans']['failed'] == 0 or args.fail_rate > 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+# backend/blob_cache.py
+"""
+镜像 blob 本地缓存
+
+扫描镜像前由服务自己按 OCI Distribution API 拉取清单和各层，按摘要保存在本地
+（内容寻址，不同镜像共享相同的基础层），再为每次扫描生成一个 OCI 布局目录
+（index.json + 硬链接到缓存的 blob），用 `trivy image --input` 扫描，
+trivy 不再访问远端仓库。配合 REGISTRY_MIRRORS 指向的 registry:2 pull-through
+镜像站，未命中的层也只从内网镜像站下载。
+
+    BLOB_CACHE_DIR        缓存目录，未设置时不启用（trivy 直接拉取镜像）
+    BLOB_CACHE_MAX_BYTES  缓存容量上限，超出后按最近使用时间淘汰（默认 20GiB）
+    IMAGE_PLATFORM        多架构镜像选用的平台（默认 linux/amd64）
+
+目录结构（多 worker 部署时放在共享卷上，布局目录与缓存须在同一文件系统以便硬链接）：
+
+    blobs/sha256/<hex>      blob 与清单，mtime 记录最近一次使用时间
+    layouts/<任务 ID>/      单次扫描的 OCI 布局目录，扫描结束后删除
+    stats/<主机>-<pid>.json 各进程的命中统计，汇总后输出到健康检查
+"""
+import errno
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+from contextlib import contextmanager
+
+import registry
+
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+CHUNK_SIZE = 1024 * 1024
+
+# 淘汰时清理到容量上限的这个比例，避免每次拉取都触发淘汰
+EVICT_LOW_WATERMARK = 0.9
+
+INDEX_TYPES = (
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json'
+)
+
+STAT_FIELDS = ('pulls', 'hits', 'misses', 'bytes_hit', 'bytes_fetched', 'evictions', 'bytes_evicted', 'errors')
+
+class BlobCache:
+    """内容寻址的 blob 缓存，负责拉取、生成扫描用的 OCI 布局以及按 LRU 淘汰"""
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, platform='linux/amd64'):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.platform = platform
+        self.blob_dir = os.path.join(root, 'blobs', 'sha256')
+        self.layout_dir = os.path.join(root, 'layouts')
+        self.stats_dir = os.path.join(root, 'stats')
+        for directory in (self.blob_dir, self.layout_dir, self.stats_dir):
+            os.makedirs(directory, exist_ok=True)
+
+        self.stats_file = os.path.join(self.stats_dir, f"{socket.gethostname()}-{os.getpid()}.json")
+        self.stats = {field: 0 for field in STAT_FIELDS}
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.fetching = {}      # 摘要 -> [锁, 引用数]，同一进程内同一个 blob 只下载一次
+
+    def blob_path(self, digest):
+        algorithm, _, hex_digest = digest.partition(':')
+        if algorithm != 'sha256' or len(hex_digest) != 64:
+            raise registry.RegistryError(f"不支持的摘要: {digest}")
+        return os.path.join(self.blob_dir, hex_digest)
+
+    def _count(self, **fields):
+        with self.lock:
+            for field, value in fields.items():
+                self.stats[field] += value
+
+    def _save_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        tmp = f"{self.stats_file}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(stats, f)
+        os.replace(tmp, self.stats_file)
+
+    @contextmanager
+    def _digest_lock(self, digest):
+        """按摘要互斥；没有线程等待时删除条目，fetching 只保留正在处理的摘要"""
+        with self.lock:
+            entry = self.fetching.setdefault(digest, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.fetching[digest]
+
+    def _write_blob(self, digest, data):
+        """保存已在内存中的 blob（清单），返回路径"""
+        path = self.blob_path(digest)
+        if hashlib.sha256(data).hexdigest() != digest.split(':', 1)[1]:
+            raise registry.RegistryError(f"清单内容与摘要不符: {digest}")
+        if not os.path.exists(path):
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        else:
+            os.utime(path)
+        return path
+
+    def _ensure_blob(self, ref, digest, size):
+        """确保 blob 在缓存中，返回路径；命中时刷新最近使用时间"""
+        path = self.blob_path(digest)
+        with self._digest_lock(digest):
+            if os.path.exists(path):
+                os.utime(path)
+                self._count(hits=1, bytes_hit=size)
+                return path
+
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            sha = hashlib.sha256()
+            written = 0
+            try:
+                with registry.open_blob(ref, digest) as resp, open(tmp, 'wb') as f:
+                    while True:
+                        chunk = resp.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        sha.update(chunk)
+                        f.write(chunk)
+                        written += len(chunk)
+                if sha.hexdigest() != digest.split(':', 1)[1]:
+                    raise registry.RegistryError(f"下载的 blob 与摘要不符: {digest}")
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+        self._count(misses=1, bytes_fetched=written)
+        return path
+
+    def _select_manifest(self, ref, media_type, body, digest):
+        """多架构镜像按 IMAGE_PLATFORM 选出单一平台的清单"""
+        if media_type not in INDEX_TYPES:
+            return media_type, body, digest
+
+        os_name, _, arch = self.platform.partition('/')
+        arch, _, variant = arch.partition('/')
+        for entry in json.loads(body).get('manifests', []):
+            platform = entry.get('platform', {})
+            if platform.get('os') == os_name and platform.get('architecture') == arch \
+                    and (not variant or platform.get('variant') == variant):
+                return registry.fetch_manifest(ref, entry['digest'])
+        raise registry.RegistryError(f"镜像没有 {self.platform} 平台的清单")
+
+    def pull(self, image):
+        """
+        把镜像的清单、配置和各层拉入缓存
+
+        返回 (镜像摘要, 单平台清单的描述符, 配置与各层的摘要列表)。
+        镜像摘要是 tag 当前指向的清单摘要，与 registry.resolve_digest() 的结果一致。
+        """
+        ref = registry.parse_reference(image)
+        try:
+            media_type, body, digest = registry.fetch_manifest(ref, ref.reference)
+            self._write_blob(digest, body)
+            media_type, body, manifest_digest = self._select_manifest(ref, media_type, body, digest)
+            self._write_blob(manifest_digest, body)
+
+            manifest = json.loads(body)
+            blobs = [manifest['config']] + manifest.get('layers', [])
+            for blob in blobs:
+                self._ensure_blob(ref, blob['digest'], blob.get('size', 0))
+        except Exception:
+            self._count(errors=1)
+            self._save_stats()
+            raise
+
+        self._count(pulls=1)
+        self._save_stats()
+        descriptor = {'mediaType': media_type, 'digest': manifest_digest, 'size': len(body)}
+        return digest, descriptor, [b['digest'] for b in blobs]
+
+    def _link(self, digest, layout):
+        target = os.path.join(layout, 'blobs', 'sha256', digest.split(':', 1)[1])
+        try:
+            os.link(self.blob_path(digest), target)
+        except OSError as e:
+            if e.errno == errno.EXDEV:   # 跨文件系统时退化为复制
+                shutil.copyfile(self.blob_path(digest), target)
+            else:
+                raise
+
+    def prepare_layout(self, image, name):
+        """拉取镜像并生成扫描用的 OCI 布局目录，返回 (布局目录, 镜像摘要)"""
+        digest, descriptor, blobs = self.pull(image)
+
+        layout = os.path.join(self.layout_dir, name)
+        shutil.rmtree(layout, ignore_errors=True)
+        os.makedirs(os.path.join(layout, 'blobs', 'sha256'))
+        try:
+            for blob in dict.fromkeys([descriptor['digest']] + blobs):
+                try:
+                    self._link(blob, layout)
+                except FileNotFoundError:
+                    # 拉取后被其他进程淘汰，重新拉取一次
+                    self.pull(image)
+                    self._link(blob, layout)
+
+            with open(os.path.join(layout, 'oci-layout'), 'w') as f:
+                json.dump({'imageLayoutVersion': '1.0.0'}, f)
+            descriptor['annotations'] = {'org.opencontainers.image.ref.name': image}
+            with open(os.path.join(layout, 'index.json'), 'w') as f:
+                json.dump({'schemaVersion': 2, 'manifests': [descriptor]}, f)
+        except Exception:
+            self.release(layout)
+            raise
+
+        self.evict()
+        return layout, digest
+
+    def release(self, layout):
+        """扫描结束后删除布局目录（只删除硬链接，缓存中的 blob 保留）"""
+        shutil.rmtree(layout, ignore_errors=True)
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.blob_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """总大小超过上限时，按最近使用时间从旧到新删除 blob"""
+        if not self.evict_lock.acquire(blocking=False):
+            return
+        try:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_bytes:
+                return
+
+            target = self.max_bytes * EVICT_LOW_WATERMARK
+            evicted = freed = 0
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                evicted += 1
+                freed += size
+
+            self._count(evictions=evicted, bytes_evicted=freed)
+            self._save_stats()
+            print(f"[blob-cache] 淘汰 {evicted} 个 blob，释放 {freed} 字节")
+        finally:
+            self.evict_lock.release()
+
+    def get_stats(self):
+        """汇总所有进程的命中统计及当前缓存占用"""
+        totals = {field: 0 for field in STAT_FIELDS}
+        for name in os.listdir(self.stats_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.stats_dir, name), 'r') as f:
+                    stats = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for field in STAT_FIELDS:
+                totals[field] += stats.get(field, 0)
+
+        entries = self._entries()
+        requests = totals['hits'] + totals['misses']
+        transferred = totals['bytes_hit'] + totals['bytes_fetched']
+        totals.update({
+            'enabled': True,
+            'blobs': len(entries),
+            'size_bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+            'hit_rate': round(totals['hits'] / requests, 4) if requests else None,
+            'byte_hit_rate': round(totals['bytes_hit'] / transferred, 4) if transferred else None,
+            'mirrors': registry.MIRRORS
+        })
+        return totals
+
+def open_blob_cache(root):
+    """根据 BLOB_CACHE_DIR 创建缓存；未配置时返回 None（由 trivy 直接拉取镜像）"""
+    if not root:
+        return None
+    return BlobCache(
+        root,
+        max_bytes=int(os.environ.get('BLOB_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+        platform=os.environ.get('IMAGE_PLATFORM', 'linux/amd64')
+    )
@@ -0,0 +1,181 @@
+# backend/fake_trivy.py
+"""
+压测用的 trivy 替身
+
+只模拟服务用到的命令行行为：`trivy version [--format json]`、`--download-db-only`、
+`trivy <子命令> --format json|cyclonedx --output <文件> ... <目标>`。
+报告内容由目标名做种子确定性生成（`trivy sbom` 使用 SBOM 中记录的镜像名，
+`--input <OCI 布局目录>` 使用 index.json 中的 ref.name 注解），
+大小和耗时通过环境变量控制：
+
+    FAKE_TRIVY_RESULTS   每份报告的 Result 数量（默认 3）
+    FAKE_TRIVY_VULNS     每个 Result 的漏洞数量（默认 50）
+    FAKE_TRIVY_LATENCY   每次扫描的模拟耗时，秒（默认 0.5）
+    FAKE_TRIVY_SBOM_LATENCY  `trivy sbom` 的模拟耗时，秒（默认为上一项的 10%）
+    FAKE_TRIVY_JITTER    耗时随机抖动比例，0~1（默认 0.2）
+    FAKE_TRIVY_FAIL_RATE 扫描失败概率，0~1（默认 0）
+    FAKE_TRIVY_DB_VERSION  `trivy version --format json` 报告的漏洞库 UpdatedAt
+"""
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+SEVERITIES = ['CRITICAL', 'HIGH', 'MEDIUM', 'LOW']
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+def build_report(target, results, vulns):
+    """生成与 trivy JSON 输出结构一致的合成报告"""
+    rng = random.Random(target)
+    report = {
+        'SchemaVersion': 2,
+        'ArtifactName': target,
+        'ArtifactType': 'container_image',
+        'Metadata': {'OS': {'Family': 'alpine', 'Name': '3.19.0'}},
+        'Results': []
+    }
+
+    for r in range(results):
+        vulnerabilities = []
+        for v in range(vulns):
+            pkg = f"pkg-{r}-{rng.randrange(vulns)}"
+            vulnerabilities.append({
+                'VulnerabilityID': f"CVE-20{rng.randint(10, 24)}-{rng.randint(1000, 99999)}",
+                'PkgName': pkg,
+                'InstalledVersion': f"1.{rng.randint(0, 9)}.{rng.randint(0, 20)}",
+                'FixedVersion': f"1.{rng.randint(0, 9)}.{rng.randint(21, 40)}" if rng.random() < 0.7 else '',
+                'Severity': rng.choice(SEVERITIES),
+                'Title': f"Synthetic vulnerability {v} in {pkg}",
+                'Description': 'Synthetic description for load testing. ' * rng.randint(1, 8),
+                'PrimaryURL': f"https://avd.aquasec.com/nvd/{pkg}"
+            })
+        report['Results'].append({
+            'Target': f"{target} (layer {r})",
+            'Class': 'os-pkgs',
+            'Type': 'alpine',
+            'Vulnerabilities': vulnerabilities
+        })
+
+    return report
+
+def build_cyclonedx(target):
+    """生成带镜像摘要属性的最小 CycloneDX 文档"""
+    digest = hashlib.sha256(target.encode('utf-8')).hexdigest()
+    repo = target.rsplit(':', 1)[0] if ':' in target.split('/')[-1] else target
+    return {
+        'bomFormat': 'CycloneDX',
+        'specVersion': '1.5',
+        'metadata': {
+            'component': {
+                'type': 'container',
+                'name': target,
+                'properties': [
+                    {'name': 'aquasecurity:trivy:RepoDigest', 'value': f"{repo}@sha256:{digest}"},
+                    {'name': 'aquasecurity:trivy:ImageID', 'value': f"sha256:{digest}"}
+                ]
+            }
+        },
+        'components': []
+    }
+
+def main(argv):
+    if not argv:
+        print('fake trivy: missing command', file=sys.stderr)
+        return 1
+
+    if argv[0] == 'version':
+        if 'json' in argv:
+            print(json.dumps({
+                'Version': '0.0.0-fake',
+                'VulnerabilityDB': {'Version': 2, 'UpdatedAt': os.environ.get('FAKE_TRIVY_DB_VERSION', '2024-01-01T00:00:00Z')}
+            }))
+        else:
+            print('Version: 0.0.0-fake')
+        return 0
+
+    if '--download-db-only' in argv:
+        return 0
+
+    subcommand = argv[0]
+    output_file = None
+    output_format = 'table'
+    input_path = None
+    positional = []
+    args = argv[1:]
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('--'):
+            if '=' in arg:
+                key, value = arg.split('=', 1)
+            elif i + 1 < len(args) and not args[i + 1].startswith('--'):
+                key, value = arg, args[i + 1]
+                i += 1
+            else:
+                key, value = arg, None
+            if key in ('--output', '-o'):
+                output_file = value
+            elif key in ('--format', '-f'):
+                output_format = value
+            elif key == '--input':
+                input_path = value
+        else:
+            positional.append(arg)
+        i += 1
+
+    target = positional[-1] if positional else 'unknown'
+    if input_path and os.path.isdir(input_path):
+        with open(os.path.join(input_path, 'index.json'), 'r') as f:
+            manifest = json.load(f)['manifests'][0]
+        target = manifest.get('annotations', {}).get('org.opencontainers.image.ref.name', input_path)
+
+    latency = _env_float('FAKE_TRIVY_LATENCY', 0.5)
+    sbom_file = None
+    if subcommand == 'sbom':
+        latency = _env_float('FAKE_TRIVY_SBOM_LATENCY', latency * 0.1)
+        sbom_file = target
+        with open(target, 'r') as f:
+            target = json.load(f)['metadata']['component']['name']
+    jitter = _env_float('FAKE_TRIVY_JITTER', 0.2)
+    rng = random.Random()
+    time.sleep(max(0.0, latency * (1 + rng.uniform(-jitter, jitter))))
+
+    if rng.random() < _env_float('FAKE_TRIVY_FAIL_RATE', 0.0):
+        print(f"fake trivy: simulated failure for {target}", file=sys.stderr)
+        return 1
+
+    if output_format == 'cyclonedx':
+        data = json.dumps(build_cyclonedx(target), indent=2)
+    else:
+        report = build_report(target, _env_int('FAKE_TRIVY_RESULTS', 3), _env_int('FAKE_TRIVY_VULNS', 50))
+        if sbom_file:
+            # 与真实 trivy 一致：扫描 SBOM 时报告中的对象是 SBOM 文件本身
+            report['ArtifactName'] = sbom_file
+            report['ArtifactType'] = 'cyclonedx'
+        elif input_path:
+            report['ArtifactName'] = input_path
+        data = json.dumps(report, indent=2)
+
+    if output_file:
+        with open(output_file, 'w') as f:
+            f.write(data)
+    else:
+        sys.stdout.write(data)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
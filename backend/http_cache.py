@@ -0,0 +1,210 @@
+# backend/http_cache.py
+"""
+报告与状态接口的 HTTP 缓存支持
+
+- 强 ETag：文件按内容 SHA-256 计算，已完成任务按报告摘要计算，其余任务按响应体计算
+- If-None-Match 命中时返回 304，不再传输正文
+- 已完成任务的内容不会再变化，返回 Cache-Control: immutable
+- 报告文件在扫描完成时一次性生成 .gz / .br 预压缩版本，按 Accept-Encoding 选择
+- 未压缩版本支持 Range 请求，大文件下载可断点续传
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from flask import Response, current_app, request, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE = 'private, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+# 小于该大小的正文不值得压缩
+MIN_COMPRESS_SIZE = 1024
+
+_digest_cache = OrderedDict()
+_digest_lock = threading.Lock()
+DIGEST_CACHE_SIZE = int(os.environ.get('DIGEST_CACHE_SIZE', '1024'))
+
+_body_cache = OrderedDict()
+_body_cache_lock = threading.Lock()
+BODY_CACHE_SIZE = int(os.environ.get('STATUS_CACHE_SIZE', '64'))
+
+def file_digest(path):
+    """文件内容的 SHA-256，按 (路径, mtime, 大小) 缓存"""
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    with _digest_lock:
+        if key in _digest_cache:
+            _digest_cache.move_to_end(key)
+            return _digest_cache[key]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    with _digest_lock:
+        _digest_cache[key] = digest
+        _digest_cache.move_to_end(key)
+        while len(_digest_cache) > DIGEST_CACHE_SIZE:
+            _digest_cache.popitem(last=False)
+    return digest
+
+def precompress(path):
+    """生成 path.gz 与 path.br（需要 brotli 包）预压缩文件"""
+    if not os.path.exists(path) or os.path.getsize(path) < MIN_COMPRESS_SIZE:
+        return
+
+    tmp = f"{path}.gz.tmp"
+    with open(path, 'rb') as src, gzip.open(tmp, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp, f"{path}.gz")
+
+    if brotli is not None:
+        with open(path, 'rb') as f:
+            data = brotli.compress(f.read(), quality=9)
+        tmp = f"{path}.br.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, f"{path}.br")
+
+def remove_variants(path):
+    for suffix in ('.gz', '.br'):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+def _choose_encoding():
+    """根据 Accept-Encoding 选择压缩方式（不处理 Range 请求）"""
+    if request.range is not None:
+        return None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def not_modified(etag, cache_control):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response
+
+def send_report_file(path, mimetype, immutable, download_name=None):
+    """
+    发送报告文件
+
+    优先使用与文件内容一致的预压缩版本；Range 请求只走未压缩版本。
+    ETag 带编码后缀，不同编码的表示互不混淆。
+    """
+    digest = file_digest(path)
+    cache_control = IMMUTABLE if immutable else REVALIDATE
+
+    encoding = _choose_encoding()
+    suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding)
+    if suffix and not _variant_fresh(path, path + suffix):
+        encoding, suffix = None, None
+
+    etag = f"{digest}-{encoding}" if encoding else digest
+    if request.if_none_match.contains(etag):
+        return not_modified(etag, cache_control)
+
+    response = send_file(
+        path + suffix if suffix else path,
+        mimetype=mimetype,
+        as_attachment=download_name is not None,
+        download_name=download_name,
+        etag=etag,
+        conditional=True,
+        max_age=None
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response
+
+def _variant_fresh(path, variant):
+    try:
+        return os.path.getmtime(variant) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+def _matching_etag(etag):
+    """If-None-Match 命中任一编码版本即可返回 304（内容相同）"""
+    for candidate in (etag, f"{etag}-gzip", f"{etag}-br"):
+        if request.if_none_match.contains(candidate):
+            return candidate
+    return None
+
+def send_json(payload_fn, etag, immutable):
+    """
+    发送 JSON，支持 304 与压缩
+
+    payload_fn 只在需要正文时调用；immutable 时序列化与压缩结果按 ETag 缓存。
+    """
+    cache_control = IMMUTABLE if immutable else REVALIDATE
+    matched = _matching_etag(etag)
+    if matched:
+        return not_modified(matched, cache_control)
+
+    encoding = _choose_encoding()
+    key = (etag, encoding)
+    body = _cache_get(key) if immutable else None
+    if body is None:
+        raw = _cache_get((etag, None)) if immutable else None
+        if raw is None:
+            raw = (current_app.json.dumps(payload_fn()) + '\n').encode('utf-8')
+            if immutable:
+                _cache_put((etag, None), raw)
+        body = raw
+        if encoding and len(raw) >= MIN_COMPRESS_SIZE:
+            body = brotli.compress(raw, quality=5) if encoding == 'br' else gzip.compress(raw, compresslevel=6)
+            if immutable:
+                _cache_put(key, body)
+        elif encoding:
+            encoding = None
+
+    response = Response(body, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response
+
+def _cache_get(key):
+    with _body_cache_lock:
+        body = _body_cache.get(key)
+        if body is not None:
+            _body_cache.move_to_end(key)
+        return body
+
+def _cache_put(key, body):
+    with _body_cache_lock:
+        _body_cache[key] = body
+        _body_cache.move_to_end(key)
+        while len(_body_cache) > BODY_CACHE_SIZE:
+            _body_cache.popitem(last=False)
+
+def payload_etag(payload):
+    """按响应体计算 ETag，响应中的任何字段变化都会更新 ETag"""
+    state = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(state.encode('utf-8')).hexdigest()[:32]
+
+def task_etag(task, fields):
+    """按任务字段计算 ETag；fields 需包含任务 ID，避免不同任务共用缓存的响应体"""
+    state = json.dumps([task.get(field) for field in fields], sort_keys=True, default=str)
+    return hashlib.sha256(state.encode('utf-8')).hexdigest()[:32]
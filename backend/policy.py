@@ -0,0 +1,202 @@
+# backend/policy.py
+"""
+扫描结果策略判定
+
+策略在创建任务时编译一次，扫描完成时对精简的漏洞索引求值，
+结果（通过 / 不通过 + 违规 CVE 列表）随任务保存，
+流水线只需请求 GET /api/scan/<id>/verdict，无需下载和解析完整报告。
+
+策略格式：
+
+    {
+      "fail_on": "HIGH",                  # 该等级及以上视为违规，默认 CRITICAL
+      "ignore_unfixed": true,             # 忽略没有修复版本的漏洞
+      "allow_cves": ["CVE-2023-1234"],    # 全局放行的 CVE
+      "exceptions": [                     # 按软件包放行
+        {"package": "openssl", "cves": ["CVE-2023-5678"]},
+        {"package": "busybox"}            # 不写 cves 表示放行该包全部漏洞
+      ]
+    }
+
+配置扫描的问题（Misconfigurations）同样参与判定：检查项 ID（如 AVD-KSV-0001）
+相当于 CVE，所在文件相当于软件包，可用 allow_cves / exceptions 放行。
+
+默认策略可通过 POLICY_FILE 指定 JSON 文件，服务启动时读取并校验。
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+SEVERITY_ORDER = ['LOW', 'MEDIUM', 'HIGH', 'CRITICAL']
+
+DEFAULT_POLICY = {'fail_on': 'CRITICAL', 'ignore_unfixed': False}
+
+# 编译结果按策略内容缓存（LRU），策略来自请求，需限制条目数
+COMPILED_CACHE_SIZE = int(os.environ.get('POLICY_CACHE_SIZE', '256'))
+
+_compiled_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+class CompiledPolicy:
+    """编译后的策略，求值时只做集合查找"""
+
+    __slots__ = ('severities', 'ignore_unfixed', 'allow_cves', 'package_rules', 'spec')
+
+    def __init__(self, severities, ignore_unfixed, allow_cves, package_rules, spec):
+        self.severities = severities
+        self.ignore_unfixed = ignore_unfixed
+        self.allow_cves = allow_cves
+        self.package_rules = package_rules   # 包名 -> 放行的 CVE 集合，None 表示全部放行
+        self.spec = spec
+
+    def is_violation(self, vuln_id, pkg, severity, fixed):
+        if severity not in self.severities:
+            return False
+        if self.ignore_unfixed and not fixed:
+            return False
+        if vuln_id in self.allow_cves:
+            return False
+        if pkg in self.package_rules:
+            allowed = self.package_rules[pkg]
+            if allowed is None or vuln_id in allowed:
+                return False
+        return True
+
+    def check_options(self, options):
+        """
+        判定基于 trivy 已过滤的结果：扫描选项过滤掉了策略要判定的等级或未修复漏洞时，
+        违规项根本不会出现在报告中，这种组合直接拒绝（ValueError）
+        """
+        scanned = options.get('severity', SEVERITY_ORDER)
+        missing = [s for s in SEVERITY_ORDER if s in self.severities and s not in scanned]
+        if missing:
+            raise ValueError(f"options.severity 未包含策略 fail_on 覆盖的等级: {', '.join(missing)}")
+        if options.get('ignore_unfixed') and not self.ignore_unfixed:
+            raise ValueError('options.ignore_unfixed 会过滤掉策略要判定的未修复漏洞，策略需同时设置 ignore_unfixed')
+
+    def evaluate(self, index):
+        """对漏洞索引求值，返回判定结果"""
+        violations = sorted({entry[0] for entry in index if self.is_violation(*entry)})
+        return {
+            'pass': not violations,
+            'violations': violations,
+            'violation_count': len(violations)
+        }
+
+def compile_policy(spec):
+    """校验并编译策略；格式错误时抛出 ValueError。相同策略复用编译结果"""
+    if spec is None:
+        spec = default_policy()
+    if not isinstance(spec, dict):
+        raise ValueError('policy 必须是对象')
+
+    key = json.dumps(spec, sort_keys=True)
+    with _cache_lock:
+        if key in _compiled_cache:
+            _compiled_cache.move_to_end(key)
+            return _compiled_cache[key]
+
+    unknown = set(spec) - {'fail_on', 'ignore_unfixed', 'allow_cves', 'exceptions'}
+    if unknown:
+        raise ValueError(f"policy 包含未知字段: {', '.join(sorted(unknown))}")
+
+    fail_on = str(spec.get('fail_on', 'CRITICAL')).upper()
+    if fail_on not in SEVERITY_ORDER:
+        raise ValueError(f"fail_on 必须是 {', '.join(SEVERITY_ORDER)} 之一")
+    severities = frozenset(SEVERITY_ORDER[SEVERITY_ORDER.index(fail_on):])
+
+    ignore_unfixed = spec.get('ignore_unfixed', False)
+    if not isinstance(ignore_unfixed, bool):
+        raise ValueError('ignore_unfixed 必须是布尔值')
+
+    allow_cves = spec.get('allow_cves', [])
+    if not isinstance(allow_cves, list) or not all(isinstance(c, str) for c in allow_cves):
+        raise ValueError('allow_cves 必须是字符串列表')
+
+    package_rules = {}
+    exceptions = spec.get('exceptions', [])
+    if not isinstance(exceptions, list):
+        raise ValueError('exceptions 必须是列表')
+    for rule in exceptions:
+        if not isinstance(rule, dict) or not isinstance(rule.get('package'), str):
+            raise ValueError('exceptions 的每一项都必须包含 package')
+        cves = rule.get('cves')
+        if cves is None:
+            package_rules[rule['package']] = None
+        elif isinstance(cves, list) and all(isinstance(c, str) for c in cves):
+            if rule['package'] in package_rules and package_rules[rule['package']] is None:
+                continue
+            package_rules[rule['package']] = package_rules.get(rule['package'], frozenset()) | frozenset(cves)
+        else:
+            raise ValueError('exceptions 的 cves 必须是字符串列表')
+
+    compiled = CompiledPolicy(
+        severities=severities,
+        ignore_unfixed=ignore_unfixed,
+        allow_cves=frozenset(allow_cves),
+        package_rules=package_rules,
+        spec=spec
+    )
+    with _cache_lock:
+        _compiled_cache[key] = compiled
+        _compiled_cache.move_to_end(key)
+        while len(_compiled_cache) > COMPILED_CACHE_SIZE:
+            _compiled_cache.popitem(last=False)
+    return compiled
+
+def failed_misconfigurations(res):
+    """一个 Result 中未通过的配置检查（trivy 默认只输出 FAIL，带 --include-non-failures 时会有 PASS）"""
+    return [m for m in res.get('Misconfigurations') or [] if m.get('Status', 'FAIL') != 'PASS']
+
+def build_index(result):
+    """从 trivy 报告提取 (漏洞 / 检查项 ID, 包名 / 文件, 等级, 是否有修复版本) 索引"""
+    index = set()
+    if not result:
+        return index
+    for res in result.get('Results', []) or []:
+        for vuln in res.get('Vulnerabilities') or []:
+            index.add((
+                vuln.get('VulnerabilityID', ''),
+                vuln.get('PkgName', ''),
+                vuln.get('Severity', '').upper(),
+                bool(vuln.get('FixedVersion'))
+            ))
+        # 配置问题总是可以修复，不受 ignore_unfixed 影响
+        for misconf in failed_misconfigurations(res):
+            index.add((
+                misconf.get('AVDID') or misconf.get('ID', ''),
+                res.get('Target', ''),
+                misconf.get('Severity', '').upper(),
+                True
+            ))
+    return index
+
+_default_policy = None
+
+def load_default_policy():
+    """读取并校验默认策略（服务启动时调用），POLICY_FILE 缺失或格式错误时抛出 ValueError"""
+    global _default_policy
+    path = os.environ.get('POLICY_FILE')
+    if path:
+        try:
+            with open(path, 'r') as f:
+                spec = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"无法读取 POLICY_FILE {path}: {e}")
+    else:
+        spec = dict(DEFAULT_POLICY)
+
+    _default_policy = None
+    try:
+        compile_policy(spec)
+    except ValueError as e:
+        raise ValueError(f"默认策略无效: {e}")
+    _default_policy = spec
+    return spec
+
+def default_policy():
+    """默认策略，优先读取 POLICY_FILE"""
+    if _default_policy is None:
+        return load_default_policy()
+    return _default_policy
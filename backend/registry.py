@@ -0,0 +1,209 @@
+# backend/registry.py
+"""
+镜像仓库（OCI Distribution API）访问
+
+只实现服务需要的部分：解析镜像名、匿名 / Basic 认证换取 Bearer token、
+查询清单摘要、读取清单与 blob。
+
+    REGISTRY_CREDENTIALS  JSON，{"registry.example.com": "user:password"}
+    REGISTRY_INSECURE     使用 http 访问的仓库，逗号分隔（如本地 registry:2）
+    REGISTRY_MIRRORS      JSON，{"docker.io": "registry-mirror:5000"}，
+                          对应仓库的请求改发到镜像站（如 registry:2 pull-through 缓存）
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+DOCKER_HUB = 'docker.io'
+DOCKER_HUB_API = 'registry-1.docker.io'
+
+MANIFEST_TYPES = ', '.join([
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json'
+])
+
+INSECURE_REGISTRIES = {h.strip() for h in os.environ.get('REGISTRY_INSECURE', '').split(',') if h.strip()}
+
+try:
+    CREDENTIALS = json.loads(os.environ.get('REGISTRY_CREDENTIALS', '') or '{}')
+except ValueError:
+    CREDENTIALS = {}
+
+try:
+    MIRRORS = json.loads(os.environ.get('REGISTRY_MIRRORS', '') or '{}')
+except ValueError:
+    MIRRORS = {}
+
+REQUEST_TIMEOUT = 30
+
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+class RegistryError(Exception):
+    pass
+
+class ImageReference:
+    """解析后的镜像名：仓库地址、镜像路径、tag 或摘要"""
+
+    def __init__(self, registry, repository, tag=None, digest=None):
+        self.registry = registry
+        self.repository = repository
+        self.tag = tag
+        self.digest = digest
+
+    @property
+    def reference(self):
+        return self.digest or self.tag or 'latest'
+
+    @property
+    def api_host(self):
+        if self.registry in MIRRORS:
+            return MIRRORS[self.registry]
+        return DOCKER_HUB_API if self.registry == DOCKER_HUB else self.registry
+
+    def __str__(self):
+        name = f"{self.registry}/{self.repository}"
+        if self.digest:
+            return f"{name}@{self.digest}"
+        return f"{name}:{self.tag or 'latest'}"
+
+def parse_reference(image):
+    """按 docker 规则解析镜像名，省略仓库地址时视为 docker.io"""
+    digest = None
+    if '@' in image:
+        image, digest = image.split('@', 1)
+
+    tag = None
+    last = image.rsplit('/', 1)[-1]
+    if ':' in last:
+        image, tag = image.rsplit(':', 1)
+
+    parts = image.split('/', 1)
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        registry, repository = parts
+    else:
+        registry, repository = DOCKER_HUB, image
+
+    if registry == DOCKER_HUB and '/' not in repository:
+        repository = f"library/{repository}"
+
+    if not re.match(r'^[a-z0-9]+(?:[._/-][a-z0-9]+)*$', repository):
+        raise RegistryError(f"镜像名格式不正确: {image}")
+
+    return ImageReference(registry, repository, tag, digest)
+
+def registry_host(target):
+    """镜像所在仓库地址，用于按仓库限流与统计"""
+    try:
+        return parse_reference(target).registry
+    except RegistryError:
+        return urllib.parse.urlsplit(target).hostname or target
+
+def _scheme(host):
+    return 'http' if host in INSECURE_REGISTRIES else 'https'
+
+class _StripAuthRedirect(urllib.request.HTTPRedirectHandler):
+    """blob 下载常被重定向到对象存储，跨主机时不能带上仓库的 Authorization"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new is not None and urllib.parse.urlsplit(newurl).netloc != urllib.parse.urlsplit(req.full_url).netloc:
+            new.remove_header('Authorization')
+        return new
+
+_opener = urllib.request.build_opener(_StripAuthRedirect)
+
+def _basic_auth(registry):
+    creds = CREDENTIALS.get(registry)
+    if not creds:
+        return None
+    return 'Basic ' + base64.b64encode(creds.encode('utf-8')).decode('ascii')
+
+def _fetch_token(challenge, ref):
+    """按 WWW-Authenticate: Bearer 质询换取 token（缓存至过期前）"""
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop('realm', None)
+    if not realm:
+        raise RegistryError('仓库返回的认证质询缺少 realm')
+    params.setdefault('scope', f"repository:{ref.repository}:pull")
+
+    key = (realm, params.get('service'), params['scope'])
+    with _tokens_lock:
+        cached = _tokens.get(key)
+        if cached and cached[1] > time.time():
+            return cached[0]
+
+    req = urllib.request.Request(f"{realm}?{urllib.parse.urlencode(params)}")
+    auth = _basic_auth(ref.registry)
+    if auth:
+        req.add_header('Authorization', auth)
+    try:
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as resp:
+            data = json.load(resp)
+    except (urllib.error.URLError, ValueError) as e:
+        raise RegistryError(f"获取仓库 token 失败: {e}")
+
+    token = data.get('token') or data.get('access_token')
+    expires = time.time() + max(30, int(data.get('expires_in', 300)) - 30)
+    with _tokens_lock:
+        _tokens[key] = (token, expires)
+    return token
+
+def request(ref, method, path, accept=None):
+    """向仓库发起请求，自动处理 Bearer 认证，返回响应对象（调用方负责关闭）"""
+    url = f"{_scheme(ref.api_host)}://{ref.api_host}/v2/{ref.repository}/{path}"
+    auth = _basic_auth(ref.registry)
+
+    for _ in range(2):
+        req = urllib.request.Request(url, method=method)
+        if accept:
+            req.add_header('Accept', accept)
+        if auth:
+            req.add_header('Authorization', auth)
+        try:
+            return _opener.open(req, timeout=REQUEST_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            challenge = e.headers.get('WWW-Authenticate', '')
+            if e.code == 401 and challenge.lower().startswith('bearer'):
+                auth = f"Bearer {_fetch_token(challenge[len('bearer'):].strip(), ref)}"
+                continue
+            raise RegistryError(f"{method} {url} 失败: HTTP {e.code}")
+        except urllib.error.URLError as e:
+            raise RegistryError(f"{method} {url} 失败: {e.reason}")
+
+    raise RegistryError(f"{method} {url} 认证失败")
+
+def resolve_digest(image):
+    """查询镜像 tag 当前指向的清单摘要（HEAD 请求，不下载任何层）"""
+    ref = parse_reference(image)
+    if ref.digest:
+        return ref.digest
+
+    with request(ref, 'HEAD', f"manifests/{ref.reference}", accept=MANIFEST_TYPES) as resp:
+        digest = resp.headers.get('Docker-Content-Digest')
+    if not digest:
+        raise RegistryError(f"仓库未返回 {image} 的摘要")
+    return digest
+
+def fetch_manifest(ref, reference):
+    """读取清单，返回 (媒体类型, 原始字节, 摘要)"""
+    with request(ref, 'GET', f"manifests/{reference}", accept=MANIFEST_TYPES) as resp:
+        media_type = resp.headers.get('Content-Type', '').split(';')[0].strip()
+        body = resp.read()
+        digest = resp.headers.get('Docker-Content-Digest')
+    if not digest:
+        digest = 'sha256:' + hashlib.sha256(body).hexdigest()
+    return media_type, body, digest
+
+def open_blob(ref, digest):
+    """打开 blob 下载流（调用方负责关闭）"""
+    return request(ref, 'GET', f"blobs/{digest}")
@@ -0,0 +1,313 @@
+# backend/repo_cache.py
+"""
+仓库扫描工作区复用
+
+`trivy repo` 每次都把仓库完整克隆到临时目录。启用本缓存后，每个仓库保留一份
+bare 镜像（首次按 REPO_CLONE_FILTER 部分克隆，只取提交和目录树，文件内容按需获取），
+之后只做增量 `git fetch`；扫描时把请求的 ref 解析为提交 SHA，从镜像检出一个
+worktree（与镜像共享对象库，不复制历史）并用 `trivy fs` 扫描。
+扫描结果按 提交 SHA + 选项 + 漏洞库版本 缓存，同一提交重复扫描直接复用。
+
+    REPO_CACHE_DIR          缓存目录，未设置时不启用（使用 trivy repo）
+    REPO_CACHE_MAX_MIRRORS  保留的镜像数量上限，超出后淘汰最久未使用的（默认 50）
+    REPO_CLONE_FILTER       首次克隆的过滤条件（默认 blob:none，设为空则完整克隆）
+    REPO_RESULT_TTL         扫描结果缓存有效期，秒（默认 86400）
+
+目录结构（多 worker 部署时放在共享卷上）：
+
+    mirrors/<hash>.git      bare 镜像，mtime 记录最近一次使用时间
+    mirrors/<hash>.lock     跨进程的 fetch 锁
+    worktrees/<任务 ID>/    单次扫描的工作区，扫描结束后删除
+    results/<sha>-<key>.json 按提交缓存的扫描结果
+    stats/<主机>-<pid>.json 各进程的命中统计，汇总后输出到健康检查
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from scanners import FS_SCAN_ROOTS, trivy_db_version
+
+GIT_TIMEOUT = 1800
+
+# git 可使用的传输协议，禁用 ext:: 等；只有配置了 FS_SCAN_ROOTS 才允许本地仓库
+GIT_ALLOW_PROTOCOL = 'https:http:ssh' + (':file' if FS_SCAN_ROOTS else '')
+
+# 只同步分支和标签，不拉取 refs/pull/* 等托管平台的附加引用
+FETCH_REFSPECS = ('+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+
+STAT_FIELDS = ('clones', 'fetches', 'fetches_skipped', 'result_hits', 'result_misses', 'evictions', 'errors')
+
+class RepoError(Exception):
+    pass
+
+class RefNotFound(RepoError):
+    """镜像已更新但请求的分支 / 标签 / 提交不存在"""
+
+class RepoCache:
+    """bare 镜像池、worktree 检出与按提交的结果缓存"""
+
+    def __init__(self, root, max_mirrors=50, clone_filter='blob:none', result_ttl=86400):
+        self.root = root
+        self.max_mirrors = max_mirrors
+        self.clone_filter = clone_filter
+        self.result_ttl = result_ttl
+        self.mirror_dir = os.path.join(root, 'mirrors')
+        self.worktree_dir = os.path.join(root, 'worktrees')
+        self.result_dir = os.path.join(root, 'results')
+        self.stats_dir = os.path.join(root, 'stats')
+        for directory in (self.mirror_dir, self.worktree_dir, self.result_dir, self.stats_dir):
+            os.makedirs(directory, exist_ok=True)
+
+        self.stats_file = os.path.join(self.stats_dir, f"{socket.gethostname()}-{os.getpid()}.json")
+        self.stats = {field: 0 for field in STAT_FIELDS}
+        self.lock = threading.Lock()
+        self.url_locks = {}
+
+    def _count(self, **fields):
+        with self.lock:
+            for field, value in fields.items():
+                self.stats[field] += value
+            stats = dict(self.stats)
+        tmp = f"{self.stats_file}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(stats, f)
+        os.replace(tmp, self.stats_file)
+
+    def _git(self, *args, git_dir=None):
+        cmd = ['git']
+        if git_dir:
+            cmd.append(f"--git-dir={git_dir}")
+        cmd.extend(args)
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=GIT_TIMEOUT,
+                                    env=dict(os.environ, GIT_TERMINAL_PROMPT='0', GIT_ALLOW_PROTOCOL=GIT_ALLOW_PROTOCOL))
+        except (OSError, subprocess.SubprocessError) as e:
+            raise RepoError(f"git {args[0]} 失败: {e}")
+        if result.returncode != 0:
+            raise RepoError(f"git {args[0]} 失败: {result.stderr.strip()}")
+        return result.stdout.strip()
+
+    def mirror_path(self, url):
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.mirror_dir, f"{name}.git")
+
+    def _lock_path(self, mirror):
+        return mirror[:-len('.git')] + '.lock'
+
+    @contextmanager
+    def _mirror_lock(self, url):
+        """同一镜像的 clone / fetch 互斥：进程内用线程锁，进程间用文件锁"""
+        with self.lock:
+            thread_lock = self.url_locks.setdefault(url, threading.Lock())
+        with thread_lock, open(self._lock_path(self.mirror_path(url)), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _has_commit(self, mirror, sha):
+        if not re.match(r'^[0-9a-f]{40}$', sha):
+            return False
+        try:
+            self._git('cat-file', '-e', f"{sha}^{{commit}}", git_dir=mirror)
+            return True
+        except RepoError:
+            return False
+
+    def _sync(self, url, mirror):
+        """首次部分克隆，之后增量 fetch（调用方持有镜像锁）"""
+        if not os.path.isdir(mirror):
+            tmp = f"{mirror}.{os.getpid()}.tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            args = ['clone', '--bare', '--quiet']
+            if self.clone_filter:
+                args.append(f"--filter={self.clone_filter}")
+            try:
+                self._git(*args, url, tmp)
+            except RepoError:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            os.replace(tmp, mirror)
+            self._count(clones=1)
+        else:
+            self._git('fetch', '--prune', '--quiet', 'origin', *FETCH_REFSPECS, git_dir=mirror)
+            self._count(fetches=1)
+
+    def resolve(self, url, options):
+        """更新镜像并把 branch / tag / commit 选项解析为提交 SHA"""
+        mirror = self.mirror_path(url)
+        try:
+            with self._mirror_lock(url):
+                commit = options.get('commit', '').lower()
+                if commit and os.path.isdir(mirror) and self._has_commit(mirror, commit):
+                    # 指定完整提交且镜像中已有，无需访问远端
+                    self._count(fetches_skipped=1)
+                else:
+                    self._sync(url, mirror)
+                os.utime(mirror)
+
+                if 'commit' in options:
+                    rev = options['commit']
+                elif 'branch' in options:
+                    rev = f"refs/heads/{options['branch']}"
+                elif 'tag' in options:
+                    rev = f"refs/tags/{options['tag']}"
+                else:
+                    rev = 'HEAD'
+                try:
+                    sha = self._git('rev-parse', '--verify', '--quiet', f"{rev}^{{commit}}", git_dir=mirror)
+                except RepoError:
+                    raise RefNotFound(f"仓库中找不到 {rev}")
+        except RepoError:
+            self._count(errors=1)
+            raise
+
+        self.evict()
+        return sha
+
+    def checkout(self, url, sha, name):
+        """从镜像检出指定提交的 worktree，返回工作区路径"""
+        mirror = self.mirror_path(url)
+        worktree = os.path.join(self.worktree_dir, name)
+        self.release(url, worktree)
+        self._git('worktree', 'add', '--detach', '--force', worktree, sha, git_dir=mirror)
+        return worktree
+
+    def release(self, url, worktree):
+        """删除 worktree 及其在镜像中的登记"""
+        if not worktree:
+            return
+        shutil.rmtree(worktree, ignore_errors=True)
+        mirror = self.mirror_path(url)
+        if os.path.isdir(mirror):
+            try:
+                self._git('worktree', 'prune', git_dir=mirror)
+            except RepoError:
+                pass
+
+    def _result_path(self, sha, options):
+        # 漏洞库版本作为键的一部分，漏洞库更新后不再复用旧结果
+        version = trivy_db_version()
+        scan_options = {k: v for k, v in options.items() if k not in ('branch', 'tag', 'commit')}
+        key = hashlib.sha256(json.dumps([scan_options, version], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.result_dir, f"{sha}-{key}.json")
+
+    def load_result(self, sha, options, output_file):
+        """提交已有未过期的扫描结果时复制到 output_file，返回是否命中"""
+        path = self._result_path(sha, options)
+        try:
+            fresh = time.time() - os.path.getmtime(path) < self.result_ttl
+            if fresh:
+                shutil.copyfile(path, output_file)
+        except FileNotFoundError:
+            fresh = False
+
+        self._count(**{'result_hits' if fresh else 'result_misses': 1})
+        return fresh
+
+    def save_result(self, sha, options, output_file):
+        path = self._result_path(sha, options)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        shutil.copyfile(output_file, tmp)
+        os.replace(tmp, path)
+
+        # 顺带清理过期结果
+        now = time.time()
+        with os.scandir(self.result_dir) as it:
+            for entry in it:
+                try:
+                    if now - entry.stat().st_mtime >= self.result_ttl:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def _mirrors(self):
+        return [os.path.join(self.mirror_dir, name) for name in os.listdir(self.mirror_dir)
+                if name.endswith('.git')]
+
+    def evict(self):
+        """
+        镜像数超过上限时删除最久未使用且没有活动 worktree 的镜像
+
+        锁文件保留不删：其他进程可能已打开它并在等待锁，删除后新进程会锁到另一个文件，
+        失去互斥。淘汰只是清理，文件系统错误不影响扫描。
+        """
+        mirrors = []
+        for mirror in self._mirrors():
+            try:
+                mirrors.append((os.path.getmtime(mirror), mirror))
+            except OSError:
+                continue    # 其他进程刚淘汰
+        excess = len(mirrors) - self.max_mirrors
+        if excess <= 0:
+            return
+
+        evicted = 0
+        for _, mirror in sorted(mirrors):
+            if evicted >= excess:
+                break
+            try:
+                with open(self._lock_path(mirror), 'w') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue    # 正在 fetch
+                    try:
+                        # 持锁后再检查：等待锁期间可能已被其他进程淘汰或检出了 worktree
+                        worktrees = os.path.join(mirror, 'worktrees')
+                        if not os.path.isdir(mirror) or (os.path.isdir(worktrees) and os.listdir(worktrees)):
+                            continue
+                        shutil.rmtree(mirror)
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+            except OSError as e:
+                print(f"[repo-cache] 淘汰镜像 {mirror} 失败: {e}")
+                continue
+            evicted += 1
+
+        if evicted:
+            self._count(evictions=evicted)
+            print(f"[repo-cache] 淘汰 {evicted} 个仓库镜像")
+
+    def get_stats(self):
+        """汇总所有进程的统计及当前镜像数"""
+        totals = {field: 0 for field in STAT_FIELDS}
+        for name in os.listdir(self.stats_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.stats_dir, name), 'r') as f:
+                    stats = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for field in STAT_FIELDS:
+                totals[field] += stats.get(field, 0)
+
+        lookups = totals['result_hits'] + totals['result_misses']
+        totals.update({
+            'enabled': True,
+            'mirrors': len(self._mirrors()),
+            'max_mirrors': self.max_mirrors,
+            'result_hit_rate': round(totals['result_hits'] / lookups, 4) if lookups else None
+        })
+        return totals
+
+def open_repo_cache(root):
+    """根据 REPO_CACHE_DIR 创建缓存；未配置时返回 None（由 trivy repo 直接克隆）"""
+    if not root:
+        return None
+    return RepoCache(
+        root,
+        max_mirrors=int(os.environ.get('REPO_CACHE_MAX_MIRRORS', '50')),
+        clone_filter=os.environ.get('REPO_CLONE_FILTER', 'blob:none'),
+        result_ttl=int(os.environ.get('REPO_RESULT_TTL', '86400'))
+    )
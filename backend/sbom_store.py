@@ -0,0 +1,149 @@
+# backend/sbom_store.py
+"""
+镜像 SBOM 存储
+
+镜像首次扫描时先用 trivy 生成 CycloneDX SBOM（拉取镜像、解析各层只做这一次），
+再用 `trivy sbom` 扫描该 SBOM。SBOM 按镜像摘要和分析选项（skip_dirs / skip_files）保存，
+扫描前先向仓库查询摘要，已有对应 SBOM 时不再拉取镜像；漏洞库更新需要重扫时
+也直接扫描已保存的 SBOM，无需再次拉取镜像或解压镜像层。
+
+目录结构（SBOM_DIR，默认 SCAN_RESULTS_DIR/sboms，多节点部署时放在共享卷上）：
+
+    <摘要>[-<选项 hash>].cdx.json  SBOM，按镜像摘要与分析选项去重
+    targets/<hash>.json            镜像名 -> 最近一次扫描得到的摘要及分析选项
+"""
+import hashlib
+import json
+import os
+import re
+from datetime import datetime
+
+SBOM_FIRST = os.environ.get('SBOM_FIRST', '1') not in ('0', 'false', 'no')
+SBOM_DIR = os.environ.get(
+    'SBOM_DIR',
+    os.path.join(os.environ.get('SCAN_RESULTS_DIR', '/app/scan_results'), 'sboms')
+)
+
+# 生成 SBOM 时这些选项作用于镜像分析阶段，其余选项作用于 SBOM 扫描阶段
+ANALYSIS_OPTIONS = ('skip_dirs', 'skip_files', 'timeout')
+SBOM_SCAN_OPTIONS = ('severity', 'ignore_unfixed', 'timeout')
+
+# 影响 SBOM 内容的分析选项，参与 SBOM 的存储键（timeout 不影响内容）
+ANALYSIS_KEY_OPTIONS = ('skip_dirs', 'skip_files')
+
+def supports(options):
+    """
+    SBOM 只包含软件包信息，只有调用方明确指定 scanners: ["vuln"] 时才走 SBOM 流程
+
+    trivy image 默认的 scanners 是 vuln,secret，未指定时仍直接扫描镜像，避免丢失 secret 结果。
+    """
+    return options.get('scanners') == ['vuln']
+
+def _atomic_write(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _target_record_path(target):
+    name = hashlib.sha256(target.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(SBOM_DIR, 'targets', f"{name}.json")
+
+def analysis_options(options):
+    """影响 SBOM 内容的分析选项"""
+    options = options or {}
+    return {key: options[key] for key in ANALYSIS_KEY_OPTIONS if options.get(key)}
+
+def sbom_path(digest, options=None):
+    name = digest.replace(':', '-')
+    analysis = analysis_options(options)
+    if analysis:
+        key = hashlib.sha256(json.dumps(analysis, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        name = f"{name}-{key}"
+    return os.path.join(SBOM_DIR, f"{name}.cdx.json")
+
+def temp_path(task_id):
+    os.makedirs(SBOM_DIR, exist_ok=True)
+    return os.path.join(SBOM_DIR, f".{task_id}.cdx.json.tmp")
+
+def extract_digest(sbom_file):
+    """从 trivy 生成的 CycloneDX 中读取镜像摘要（优先 RepoDigest，其次 ImageID）"""
+    with open(sbom_file, 'r') as f:
+        doc = json.load(f)
+
+    props = {}
+    component = doc.get('metadata', {}).get('component', {})
+    for prop in component.get('properties', []) or []:
+        props.setdefault(prop.get('name'), prop.get('value'))
+
+    repo_digest = props.get('aquasecurity:trivy:RepoDigest')
+    if repo_digest and '@' in repo_digest:
+        digest = repo_digest.rsplit('@', 1)[1]
+    else:
+        digest = props.get('aquasecurity:trivy:ImageID')
+
+    if digest and re.match(r'^sha256:[0-9a-f]{64}$', digest):
+        return digest
+    return None
+
+def record_target(target, digest, options=None):
+    """记录镜像名最近一次扫描得到的摘要及生成 SBOM 时的分析选项"""
+    record_path = _target_record_path(target)
+    os.makedirs(os.path.dirname(record_path), exist_ok=True)
+    _atomic_write(record_path, {
+        'target': target,
+        'digest': digest,
+        'analysis': analysis_options(options),
+        'sbom': os.path.basename(sbom_path(digest, options)),
+        'updated_at': datetime.now().isoformat()
+    })
+
+def store(target, tmp_file, options=None, digest=None):
+    """
+    保存新生成的 SBOM，返回 (摘要, SBOM 路径)；无法识别摘要时返回 (None, 临时文件路径)
+
+    调用方已从仓库查询到摘要（或从本地 OCI 布局生成、SBOM 不含 RepoDigest）时传入 digest，
+    保证与 registry.resolve_digest() 的结果一致。
+    """
+    digest = digest or extract_digest(tmp_file)
+    if digest is None:
+        return None, tmp_file
+
+    path = sbom_path(digest, options)
+    os.replace(tmp_file, path)
+    record_target(target, digest, options)
+    return digest, path
+
+def lookup(digest, options=None):
+    """按摘要和分析选项查找已保存的 SBOM 路径"""
+    path = sbom_path(digest, options)
+    return path if os.path.exists(path) else None
+
+def list_targets():
+    """列出所有已保存 SBOM 的镜像及其最新摘要"""
+    targets_dir = os.path.join(SBOM_DIR, 'targets')
+    if not os.path.isdir(targets_dir):
+        return []
+
+    records = []
+    for name in os.listdir(targets_dir):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(targets_dir, name), 'r') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if lookup(record['digest'], record.get('analysis')):
+            records.append(record)
+
+    records.sort(key=lambda r: r['target'])
+    return records
+
+def target_digest(target):
+    """镜像最近一次扫描得到的摘要"""
+    try:
+        with open(_target_record_path(target), 'r') as f:
+            return json.load(f)['digest']
+    except (OSError, ValueError, KeyError):
+        return None
@@ -0,0 +1,218 @@
+# backend/scanners.py
+"""
+扫描类型注册表
+
+每种扫描类型对应一个 trivy 子命令，声明自己支持的选项。
+创建任务时校验 options 并规范化，执行时统一转换为 trivy 命令行参数，
+严重等级和 ignore_unfixed 过滤在 trivy 内完成，减小输出和解析开销。
+
+新增扫描类型只需调用 register_scanner()。
+"""
+import json
+import os
+import re
+import subprocess
+import time
+
+SEVERITIES = ['CRITICAL', 'HIGH', 'MEDIUM', 'LOW', 'UNKNOWN']
+DEFAULT_SEVERITIES = ['CRITICAL', 'HIGH', 'MEDIUM', 'LOW']
+TRIVY_SCANNERS = ['vuln', 'misconfig', 'secret', 'license']
+
+DEFAULT_TIMEOUT = 600
+MAX_TIMEOUT = 3600
+DB_VERSION_TTL = 300
+
+# 本地路径类扫描允许的目录前缀，冒号分隔；未设置时拒绝所有本地路径类扫描，
+# 避免 API 调用方扫描服务所在容器自身的文件系统
+FS_SCAN_ROOTS = [p for p in os.environ.get('FS_SCAN_ROOTS', '').split(':') if p]
+
+# 远程仓库地址：https / http / ssh URL 或 scp 风格的 user@host:path；
+# 本地路径与 file:// 同样受 FS_SCAN_ROOTS 限制
+REMOTE_REPO_PATTERN = re.compile(r'^(?:(?:https?|ssh)://[\w.-]+|[\w.-]+@[\w.-]+:)')
+
+class ScannerType:
+    """一种扫描类型：trivy 子命令、展示名称与支持的选项"""
+
+    def __init__(self, name, subcommand, label, label_en, options, local_path=False):
+        self.name = name
+        self.subcommand = subcommand
+        self.label = label
+        self.label_en = label_en
+        self.options = frozenset(options)
+        self.local_path = local_path
+
+SCANNER_TYPES = {}
+
+_db_version = (None, 0, False)     # (版本, 查询时间, 查询前是否已更新漏洞库)
+
+def register_scanner(name, subcommand, label, label_en, options, local_path=False):
+    SCANNER_TYPES[name] = ScannerType(name, subcommand, label, label_en, options, local_path)
+    return SCANNER_TYPES[name]
+
+COMMON_OPTIONS = ('severity', 'ignore_unfixed', 'scanners', 'skip_dirs', 'skip_files', 'timeout')
+
+register_scanner('image', 'image', 'Docker 镜像', 'Docker Image', COMMON_OPTIONS)
+register_scanner('repo', 'repo', 'GitHub 仓库', 'GitHub Repository', COMMON_OPTIONS + ('branch', 'tag', 'commit'))
+register_scanner('fs', 'fs', '文件系统', 'Filesystem', COMMON_OPTIONS, local_path=True)
+register_scanner('rootfs', 'rootfs', '根文件系统', 'Root Filesystem', COMMON_OPTIONS, local_path=True)
+register_scanner('config', 'config', '配置文件', 'Configuration',
+                 ('severity', 'skip_dirs', 'skip_files', 'timeout'), local_path=True)
+register_scanner('sbom', 'sbom', 'SBOM', 'SBOM', ('severity', 'ignore_unfixed', 'timeout'), local_path=True)
+
+def get_scanner(scan_type):
+    return SCANNER_TYPES.get(scan_type)
+
+def _string_list(value, name):
+    if isinstance(value, str):
+        value = [v.strip() for v in value.split(',') if v.strip()]
+    if not isinstance(value, list) or not all(isinstance(v, str) and v for v in value):
+        raise ValueError(f"{name} 必须是字符串列表")
+    if any(',' in v for v in value):
+        raise ValueError(f"{name} 的元素不能包含逗号")
+    return value
+
+def _ref(value, name):
+    if not isinstance(value, str) or not re.match(r'^[\w./@+-]+$', value) or value.startswith('-'):
+        raise ValueError(f"{name} 格式不正确")
+    return value
+
+def local_target(scan_type, target):
+    """扫描目标是否为服务所在主机上的路径（包括本地仓库）"""
+    if get_scanner(scan_type).local_path:
+        return True
+    return scan_type == 'repo' and not REMOTE_REPO_PATTERN.match(target)
+
+def validate_target(scan_type, target):
+    """校验扫描目标，返回错误信息或 None"""
+    if not isinstance(target, str) or target.startswith('-'):
+        return '扫描目标格式不正确'
+    if local_target(scan_type, target):
+        if not FS_SCAN_ROOTS:
+            if scan_type == 'repo':
+                return '仓库地址必须是 https://、http://、ssh:// 或 git@host: 形式的远程地址'
+            return f"未配置 FS_SCAN_ROOTS，不允许 {scan_type} 扫描"
+        path = target[len('file://'):] if target.startswith('file://') else target
+        if '://' in path:
+            return '扫描目标格式不正确'
+        real = os.path.realpath(path)
+        if not any(real == root or real.startswith(root.rstrip('/') + '/') for root in FS_SCAN_ROOTS):
+            return '扫描路径不在允许的目录范围内'
+    return None
+
+def validate_options(scan_type, options):
+    """校验并规范化扫描选项；不支持或格式错误时抛出 ValueError"""
+    scanner = get_scanner(scan_type)
+    if options is None:
+        options = {}
+    if not isinstance(options, dict):
+        raise ValueError('options 必须是对象')
+
+    unsupported = set(options) - scanner.options
+    if unsupported:
+        raise ValueError(f"{scan_type} 扫描不支持选项: {', '.join(sorted(unsupported))}")
+
+    normalized = {}
+    if 'severity' in options:
+        severity = [s.upper() for s in _string_list(options['severity'], 'severity')]
+        invalid = [s for s in severity if s not in SEVERITIES]
+        if invalid or not severity:
+            raise ValueError(f"severity 只能包含 {', '.join(SEVERITIES)}")
+        normalized['severity'] = [s for s in SEVERITIES if s in severity]
+
+    if 'ignore_unfixed' in options:
+        if not isinstance(options['ignore_unfixed'], bool):
+            raise ValueError('ignore_unfixed 必须是布尔值')
+        normalized['ignore_unfixed'] = options['ignore_unfixed']
+
+    if 'scanners' in options:
+        scanners = _string_list(options['scanners'], 'scanners')
+        invalid = [s for s in scanners if s not in TRIVY_SCANNERS]
+        if invalid or not scanners:
+            raise ValueError(f"scanners 只能包含 {', '.join(TRIVY_SCANNERS)}")
+        normalized['scanners'] = scanners
+
+    for key in ('skip_dirs', 'skip_files'):
+        if key in options:
+            normalized[key] = _string_list(options[key], key)
+
+    if 'timeout' in options:
+        timeout = options['timeout']
+        if not isinstance(timeout, int) or isinstance(timeout, bool) or not 0 < timeout <= MAX_TIMEOUT:
+            raise ValueError(f"timeout 必须是 1 到 {MAX_TIMEOUT} 之间的秒数")
+        normalized['timeout'] = timeout
+
+    refs = [key for key in ('branch', 'tag', 'commit') if key in options]
+    if len(refs) > 1:
+        raise ValueError('branch、tag、commit 只能指定一个')
+    for key in refs:
+        normalized[key] = _ref(options[key], key)
+
+    return normalized
+
+def _append_target(cmd, target, input_dir):
+    # 镜像已拉取到本地 OCI 布局目录时从目录读取，不再访问仓库
+    if input_dir:
+        cmd.extend(['--input', input_dir])
+    else:
+        cmd.append(target)
+    return cmd
+
+def build_command(scan_type, target, options, output_file, input_dir=None):
+    """把扫描类型与规范化后的选项转换为 trivy 命令"""
+    scanner = get_scanner(scan_type)
+    cmd = ['trivy', scanner.subcommand, '--format', 'json', '--output', output_file]
+
+    cmd.extend(['--severity', ','.join(options.get('severity', DEFAULT_SEVERITIES))])
+    if options.get('ignore_unfixed'):
+        cmd.append('--ignore-unfixed')
+    if options.get('scanners'):
+        cmd.extend(['--scanners', ','.join(options['scanners'])])
+    if options.get('skip_dirs'):
+        cmd.extend(['--skip-dirs', ','.join(options['skip_dirs'])])
+    if options.get('skip_files'):
+        cmd.extend(['--skip-files', ','.join(options['skip_files'])])
+    for key in ('branch', 'tag', 'commit'):
+        if key in options:
+            cmd.extend([f"--{key}", options[key]])
+    cmd.extend(['--timeout', f"{scan_timeout(options)}s"])
+
+    return _append_target(cmd, target, input_dir)
+
+def scan_timeout(options):
+    return options.get('timeout', DEFAULT_TIMEOUT)
+
+def build_sbom_command(target, options, output_file, input_dir=None):
+    """生成镜像 CycloneDX SBOM 的 trivy 命令"""
+    cmd = ['trivy', 'image', '--format', 'cyclonedx', '--output', output_file]
+    if options.get('skip_dirs'):
+        cmd.extend(['--skip-dirs', ','.join(options['skip_dirs'])])
+    if options.get('skip_files'):
+        cmd.extend(['--skip-files', ','.join(options['skip_files'])])
+    cmd.extend(['--timeout', f"{scan_timeout(options)}s"])
+
+    return _append_target(cmd, target, input_dir)
+
+def trivy_db_version(download=False):
+    """
+    本地漏洞库版本（VulnerabilityDB.UpdatedAt），结果缓存 DB_VERSION_TTL 秒
+
+    download 为 True 时先让 trivy 按需更新漏洞库再查询；获取失败返回 None。
+    """
+    global _db_version
+    version, checked, downloaded = _db_version
+    if time.time() - checked < DB_VERSION_TTL and (downloaded or not download):
+        return version
+
+    try:
+        if download:
+            subprocess.run(['trivy', 'image', '--download-db-only'],
+                           capture_output=True, timeout=600, cwd='/tmp')
+        result = subprocess.run(['trivy', 'version', '--format', 'json'],
+                                capture_output=True, text=True, timeout=30)
+        version = json.loads(result.stdout).get('VulnerabilityDB', {}).get('UpdatedAt')
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        print(f"获取漏洞库版本失败: {e}")
+        version = None
+
+    _db_version = (version, time.time(), download)
+    return version
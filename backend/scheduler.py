@@ -0,0 +1,403 @@
+# backend/scheduler.py
+"""
+定时扫描
+
+每个计划包含一组目标和 cron 表达式（分 时 日 月 周，使用服务所在时区）。
+到点后目标不会同时提交，而是在 window 秒内随机分散；提交时按仓库
+做令牌桶限流并限制同时运行的任务数。
+
+镜像目标提交前先查询仓库中的当前摘要：同一计划中该目标的摘要、漏洞库版本以及
+计划的扫描选项和策略都与上次扫描相同则跳过；只有漏洞库更新时复用已保存的 SBOM 重扫（见 sbom_store）。
+
+计划格式（SCHEDULES_FILE，默认 SCAN_RESULTS_DIR/schedules.json，也可通过 API 管理）：
+
+    [{
+      "name": "prod-daily",
+      "cron": "0 2 * * *",
+      "type": "image",
+      "targets": ["nginx:1.25", "registry.example.com/app:prod"],
+      "window": 3600,
+      "options": {"severity": ["CRITICAL", "HIGH"]},
+      "policy": {"fail_on": "HIGH"},
+      "callback_url": "https://ci.example.com/hooks/trivy"
+    }]
+
+按仓库限流（SCHEDULE_REGISTRY_LIMITS，JSON）：
+
+    {"docker.io": {"rate": 30, "concurrency": 2}}      # rate 为每分钟提交数
+"""
+import hashlib
+import heapq
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import registry
+import sbom_store
+from scanners import trivy_db_version
+
+SCHEDULER_TICK = float(os.environ.get('SCHEDULER_TICK', '1'))
+DEFAULT_RATE = float(os.environ.get('SCHEDULE_DEFAULT_RATE', '60'))
+DEFAULT_CONCURRENCY = int(os.environ.get('SCHEDULE_DEFAULT_CONCURRENCY', '4'))
+
+try:
+    REGISTRY_LIMITS = json.loads(os.environ.get('SCHEDULE_REGISTRY_LIMITS', '') or '{}')
+except ValueError:
+    REGISTRY_LIMITS = {}
+
+class CronSpec:
+    """五段式 cron 表达式，支持 *、a-b、*/n、a-b/n 与逗号列表"""
+
+    # 周字段允许 0 和 7 都表示周日
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('cron 表达式必须包含 5 个字段')
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)
+        ]
+        self.weekdays = {0 if d == 7 else d for d in self.weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            m = re.match(r'^(\*|\d+(?:-\d+)?)(?:/(\d+))?$', part)
+            if not m:
+                raise ValueError(f"cron 字段格式不正确: {field}")
+            base, step = m.group(1), int(m.group(2) or 1)
+            if base == '*':
+                start, end = low, high
+            elif '-' in base:
+                start, end = map(int, base.split('-'))
+            else:
+                start = end = int(base)
+                if m.group(2):
+                    end = high
+            if not (low <= start <= end <= high) or step < 1:
+                raise ValueError(f"cron 字段超出范围: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt):
+        weekday = (dt.weekday() + 1) % 7
+        day_ok = dt.day in self.days
+        weekday_ok = weekday in self.weekdays
+        # 与标准 cron 一致：日和周都有限制时满足其一即可
+        if not self.any_day and not self.any_weekday:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def matches(self, dt):
+        return (dt.minute in self.minutes and dt.hour in self.hours
+                and dt.month in self.months and self._day_matches(dt))
+
+    def next_after(self, dt):
+        """dt 之后的下一个触发时间（分钟精度）"""
+        start = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        for _ in range(366 * 4):
+            if day.month in self.months and self._day_matches(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        return None
+
+def validate_schedule(spec, validate_scan):
+    """校验计划，返回错误信息或 None；validate_scan 用于校验单个扫描请求"""
+    if not isinstance(spec, dict):
+        return '计划必须是对象'
+    if not isinstance(spec.get('name'), str) or not re.match(r'^[\w.-]{1,64}$', spec['name']):
+        return 'name 只能包含字母、数字、下划线、点和横线'
+    if not isinstance(spec.get('cron'), str):
+        return 'cron 必须是字符串'
+    try:
+        CronSpec(spec['cron'])
+    except ValueError as e:
+        return str(e)
+    targets = spec.get('targets')
+    if not isinstance(targets, list) or not targets:
+        return 'targets 必须是非空列表'
+    window = spec.get('window', 0)
+    if not isinstance(window, (int, float)) or isinstance(window, bool) or window < 0:
+        return 'window 必须是非负秒数'
+    for target in targets:
+        error = validate_scan({
+            'type': spec.get('type', 'image'),
+            'target': target,
+            'options': spec.get('options'),
+            'policy': spec.get('policy'),
+            'callback_url': spec.get('callback_url')
+        })
+        if error:
+            return f"{target}: {error}"
+    return None
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+def _state_key(name, target):
+    """扫描记录按 (计划名, 目标) 区分，同一目标在不同计划中的选项和策略可能不同"""
+    return json.dumps([name, target])
+
+def _config_hash(spec):
+    """影响扫描结果的计划配置"""
+    config = [spec.get('type', 'image'), spec.get('options') or {}, spec.get('policy')]
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def _atomic_write(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+class Scheduler:
+    """
+    定时扫描调度器
+
+    submit(spec, target, extra) 提交一个扫描并返回任务 ID；
+    get_task(task_id) 用于跟踪运行中的任务以释放并发名额。
+    """
+
+    def __init__(self, submit, get_task, schedules_file, state_file):
+        self.submit = submit
+        self.get_task = get_task
+        self.schedules_file = schedules_file
+        self.state_file = state_file
+
+        self.lock = threading.Lock()
+        self.schedules = {}
+        self.crons = {}
+        self.last_fired = {}    # 计划名 -> 最近一次触发的分钟
+        self.jobs = []          # 堆：(提交时间, 序号, 计划名, 目标)
+        self.seq = 0
+        self.buckets = {}
+        self.running = {}       # 任务 ID -> (仓库, 记录键, 摘要, 漏洞库版本, 配置摘要)
+        self.state = {}         # (计划名, 目标) -> 最近一次成功扫描时的 {digest, db_version, config, task_id}
+        self.stats = {'submitted': 0, 'skipped': 0, 'deferred': 0}
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        self._load()
+
+    def _load(self):
+        for path, attr in ((self.schedules_file, 'schedules'), (self.state_file, 'state')):
+            if path and os.path.exists(path):
+                try:
+                    with open(path, 'r') as f:
+                        data = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"读取 {path} 失败: {e}")
+                    continue
+                if attr == 'schedules':
+                    for spec in data:
+                        self.schedules[spec['name']] = spec
+                        self.crons[spec['name']] = CronSpec(spec['cron'])
+                else:
+                    self.state = data
+
+    def _save_schedules(self):
+        if self.schedules_file:
+            _atomic_write(self.schedules_file, list(self.schedules.values()))
+
+    def _save_state(self):
+        if self.state_file:
+            _atomic_write(self.state_file, self.state)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name='scheduler')
+            self.thread.daemon = True
+            self.thread.start()
+            print(f"定时扫描已启动，共 {len(self.schedules)} 个计划")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def put(self, spec):
+        with self.lock:
+            self.crons[spec['name']] = CronSpec(spec['cron'])
+            self.schedules[spec['name']] = spec
+            self._save_schedules()
+
+    def remove(self, name):
+        with self.lock:
+            if self.schedules.pop(name, None) is None:
+                return False
+            self.crons.pop(name, None)
+            self.jobs = [job for job in self.jobs if job[2] != name]
+            heapq.heapify(self.jobs)
+            self._save_schedules()
+            self.state = {key: last for key, last in self.state.items() if json.loads(key)[0] != name}
+            self._save_state()
+            return True
+
+    def list(self):
+        now = datetime.now()
+        with self.lock:
+            pending = {}
+            for job in self.jobs:
+                pending[job[2]] = pending.get(job[2], 0) + 1
+            result = []
+            for name, spec in sorted(self.schedules.items()):
+                next_run = self.crons[name].next_after(now)
+                result.append(dict(
+                    spec,
+                    next_run=next_run.isoformat() if next_run else None,
+                    pending=pending.get(name, 0)
+                ))
+            return result
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, queued=len(self.jobs), running=len(self.running))
+
+    def trigger(self, name, now=None):
+        """触发一次计划：目标在 window 内随机分散提交"""
+        now = time.time() if now is None else now
+        with self.lock:
+            spec = self.schedules.get(name)
+            if spec is None:
+                return 0
+            window = spec.get('window', 0)
+            for target in spec['targets']:
+                self.seq += 1
+                heapq.heappush(self.jobs, (now + random.uniform(0, window), self.seq, name, target))
+            return len(spec['targets'])
+
+    def _limits(self, host):
+        limits = REGISTRY_LIMITS.get(host, {})
+        return limits.get('rate', DEFAULT_RATE), limits.get('concurrency', DEFAULT_CONCURRENCY)
+
+    def _loop(self):
+        while not self.stop_event.wait(SCHEDULER_TICK):
+            try:
+                self._tick()
+            except Exception as e:
+                print(f"定时扫描调度出错: {e}")
+
+    def _tick(self):
+        now = datetime.now()
+        minute = now.strftime('%Y-%m-%dT%H:%M')
+        with self.lock:
+            due = [name for name, cron in self.crons.items()
+                   if cron.matches(now) and self.last_fired.get(name) != minute]
+            for name in due:
+                self.last_fired[name] = minute
+        for name in due:
+            count = self.trigger(name)
+            print(f"定时计划 {name} 已触发，{count} 个目标将在窗口期内分散提交")
+
+        self._reap()
+        self._dispatch()
+
+    def _reap(self):
+        """回收已结束任务的并发名额，成功的扫描记录摘要与漏洞库版本"""
+        with self.lock:
+            running = list(self.running.items())
+
+        finished = []
+        for task_id, info in running:
+            task = self.get_task(task_id)
+            if task is None or task['status'] in ('completed', 'failed'):
+                finished.append((task_id, info, task))
+
+        if not finished:
+            return
+        with self.lock:
+            for task_id, (host, key, digest, db_version, config), task in finished:
+                self.running.pop(task_id, None)
+                if task is not None and task['status'] == 'completed' and digest:
+                    self.state[key] = {'digest': digest, 'db_version': db_version, 'config': config, 'task_id': task_id}
+            self._save_state()
+
+    def _dispatch(self):
+        deferred = []
+        while True:
+            with self.lock:
+                if not self.jobs or self.jobs[0][0] > time.time():
+                    break
+                job = heapq.heappop(self.jobs)
+                spec = self.schedules.get(job[2])
+                if spec is None:
+                    continue
+                host = registry.registry_host(job[3])
+                rate, concurrency = self._limits(host)
+                in_flight = sum(1 for info in self.running.values() if info[0] == host)
+                bucket = self.buckets.get(host)
+                if bucket is None:
+                    bucket = self.buckets[host] = TokenBucket(rate, concurrency)
+                if in_flight >= concurrency or not bucket.take():
+                    deferred.append(job)
+                    self.stats['deferred'] += 1
+                    continue
+            self._submit_job(spec, job[3], host)
+
+        if deferred:
+            with self.lock:
+                for job in deferred:
+                    # 稍后重试，保留原有顺序
+                    heapq.heappush(self.jobs, (time.time() + 1, job[1], job[2], job[3]))
+
+    def _submit_job(self, spec, target, host):
+        scan_type = spec.get('type', 'image')
+        digest = None
+        db_version = None
+        key = _state_key(spec['name'], target)
+        config = _config_hash(spec)
+        extra = {'schedule': spec['name']}
+
+        if scan_type == 'image':
+            db_version = trivy_db_version(download=True)
+            try:
+                digest = registry.resolve_digest(target)
+            except registry.RegistryError as e:
+                print(f"[{spec['name']}] 查询 {target} 摘要失败，直接扫描: {e}")
+
+            with self.lock:
+                last = self.state.get(key)
+            if digest and last and last['digest'] == digest and last.get('config') == config:
+                if db_version and last.get('db_version') == db_version:
+                    with self.lock:
+                        self.stats['skipped'] += 1
+                    print(f"[{spec['name']}] {target} 镜像、漏洞库与计划配置均未变化，跳过")
+                    return
+                # 镜像未变，只有漏洞库更新：复用已保存的 SBOM
+                if sbom_store.supports(spec.get('options') or {}):
+                    extra['sbom_digest'] = digest
+
+        try:
+            task_id = self.submit(spec, target, extra)
+        except Exception as e:
+            print(f"[{spec['name']}] 提交 {target} 失败: {e}")
+            return
+
+        with self.lock:
+            self.running[task_id] = (host, key, digest, db_version, config)
+            self.stats['submitted'] += 1
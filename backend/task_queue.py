@@ -0,0 +1,327 @@
+# backend/task_queue.py
+"""
+共享任务队列与结果存储
+
+API 节点只负责入队和查询，扫描由独立的 worker 节点领取执行。
+worker 领取任务时获得一个有期限的租约，执行期间定期续约（心跳）；
+worker 中途退出导致租约过期后，任务会被重新投递给其他 worker，
+超过最大投递次数则标记为失败。worker 领取任务前先调用 reclaim()，
+由它返回被标记失败的任务，以便投递 scan.failed 回调。
+
+支持两种后端，由 QUEUE_URL 选择：
+    redis://host:6379/0        多机部署（需要安装 redis 包）
+    sqlite:////path/to/db      单机多进程，基于 SQLite 文件锁，也用于测试
+
+存储中只保存任务的状态字段，完整扫描结果仍写在共享的 SCAN_RESULTS_DIR 中。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+MAX_ATTEMPTS = int(os.environ.get('QUEUE_MAX_ATTEMPTS', '3'))
+
+# 回收方标记失败期间持有的租约时长，秒
+RECLAIM_SECONDS = 60
+
+def _now():
+    return time.time()
+
+def _strip(task):
+    """去掉不适合放入共享存储的字段（完整结果走文件）"""
+    return {k: v for k, v in task.items() if k != 'result'}
+
+class SqliteQueue:
+    """基于 SQLite 的队列，多进程通过数据库文件锁互斥"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                state TEXT NOT NULL,
+                owner TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                enqueued_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks (state, enqueued_at)')
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def enqueue(self, task):
+        self._conn().execute(
+            'INSERT INTO tasks (id, data, state, enqueued_at) VALUES (?, ?, ?, ?)',
+            (task['id'], json.dumps(_strip(task)), 'queued', _now())
+        )
+
+    def reclaim(self):
+        """回收过期租约：未超过次数的重新入队，超过的标记为失败并返回这些任务"""
+        conn = self._conn()
+        exhausted = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            expired = conn.execute(
+                "SELECT id, data, attempts FROM tasks WHERE state = 'leased' AND lease_expires < ?",
+                (_now(),)
+            ).fetchall()
+            for task_id, data, attempts in expired:
+                if attempts >= MAX_ATTEMPTS:
+                    task = json.loads(data)
+                    task.update(_exhausted(attempts))
+                    conn.execute(
+                        "UPDATE tasks SET state = 'done', owner = NULL, lease_expires = NULL, data = ? WHERE id = ?",
+                        (json.dumps(task), task_id)
+                    )
+                    exhausted.append(task)
+                else:
+                    conn.execute(
+                        "UPDATE tasks SET state = 'queued', owner = NULL, lease_expires = NULL WHERE id = ?",
+                        (task_id,)
+                    )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return exhausted
+
+    def lease(self, worker_id, lease_seconds):
+        """领取一个任务，返回任务字典或 None"""
+        conn = self._conn()
+        now = _now()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                "SELECT id, data, attempts FROM tasks WHERE state = 'queued' ORDER BY enqueued_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+
+            task_id, data, attempts = row
+            task = json.loads(data)
+            task['status'] = 'running'
+            task['attempts'] = attempts + 1
+            task['worker'] = worker_id
+            conn.execute(
+                "UPDATE tasks SET state = 'leased', owner = ?, lease_expires = ?, attempts = ?, data = ? WHERE id = ?",
+                (worker_id, now + lease_seconds, attempts + 1, json.dumps(task), task_id)
+            )
+            conn.execute('COMMIT')
+            return task
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def heartbeat(self, task_id, worker_id, lease_seconds):
+        """续约；租约已丢失时返回 False"""
+        cur = self._conn().execute(
+            "UPDATE tasks SET lease_expires = ? WHERE id = ? AND state = 'leased' AND owner = ?",
+            (_now() + lease_seconds, task_id, worker_id)
+        )
+        return cur.rowcount == 1
+
+    def complete(self, task_id, worker_id, task):
+        """提交最终状态并释放租约；租约已丢失时返回 False"""
+        cur = self._conn().execute(
+            "UPDATE tasks SET state = 'done', owner = NULL, lease_expires = NULL, data = ? "
+            "WHERE id = ? AND state = 'leased' AND owner = ?",
+            (json.dumps(_strip(task)), task_id, worker_id)
+        )
+        return cur.rowcount == 1
+
+    def get(self, task_id):
+        row = self._conn().execute('SELECT data FROM tasks WHERE id = ?', (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list(self):
+        rows = self._conn().execute('SELECT data FROM tasks').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+
+    def depth(self):
+        return self._conn().execute("SELECT COUNT(*) FROM tasks WHERE state = 'queued'").fetchone()[0]
+
+class RedisQueue:
+    """
+    基于 Redis 的队列
+
+    trivy:queue          待执行任务 ID 列表
+    trivy:leases         有序集合，任务 ID -> 租约到期时间
+    trivy:tasks          有序集合，任务 ID -> 创建时间（用于列表）
+    trivy:task:<id>      哈希，data / owner / attempts
+
+    出队与登记租约、回收过期租约与重新入队、续约与提交结果都在 Lua 脚本中完成，
+    worker 在两步之间退出也不会丢失任务，租约被接管后旧 worker 的写入会被拒绝。
+    """
+
+    QUEUE_KEY = 'trivy:queue'
+    LEASES_KEY = 'trivy:leases'
+    TASKS_KEY = 'trivy:tasks'
+    TASK_PREFIX = 'trivy:task:'
+
+    # KEYS: queue, leases  ARGV: 租约到期时间, worker, 任务键前缀
+    LEASE_SCRIPT = """
+    local task_id = redis.call('RPOP', KEYS[1])
+    if not task_id then
+        return nil
+    end
+    local key = ARGV[3] .. task_id
+    redis.call('ZADD', KEYS[2], ARGV[1], task_id)
+    redis.call('HSET', key, 'owner', ARGV[2])
+    local attempts = redis.call('HINCRBY', key, 'attempts', 1)
+    return {task_id, attempts, redis.call('HGET', key, 'data')}
+    """
+
+    # KEYS: leases, queue  ARGV: 当前时间, 任务键前缀, 最大投递次数, 回收租约到期时间
+    # 未超过次数的过期任务原子地移回队列；超过次数的由调用方标记失败，
+    # 期间租约转给回收方（owner 为空串），其他 worker 不会重复回收；回收方中途退出时到期后重做
+    RECLAIM_SCRIPT = """
+    local exhausted = {}
+    for _, task_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1])) do
+        local key = ARGV[2] .. task_id
+        local attempts = tonumber(redis.call('HGET', key, 'attempts') or '0')
+        if attempts >= tonumber(ARGV[3]) then
+            redis.call('ZADD', KEYS[1], ARGV[4], task_id)
+            redis.call('HSET', key, 'owner', '')
+            table.insert(exhausted, task_id)
+        else
+            redis.call('ZREM', KEYS[1], task_id)
+            redis.call('HDEL', key, 'owner')
+            redis.call('RPUSH', KEYS[2], task_id)
+        end
+    end
+    return exhausted
+    """
+
+    # KEYS: leases, 任务键  ARGV: 任务 ID, worker, 新的租约到期时间
+    HEARTBEAT_SCRIPT = """
+    if redis.call('HGET', KEYS[2], 'owner') ~= ARGV[2] or not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+        return 0
+    end
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+    return 1
+    """
+
+    # KEYS: leases, 任务键  ARGV: 任务 ID, worker, 最终任务数据
+    COMPLETE_SCRIPT = """
+    if redis.call('HGET', KEYS[2], 'owner') ~= ARGV[2] then
+        return 0
+    end
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HSET', KEYS[2], 'data', ARGV[3])
+    redis.call('HDEL', KEYS[2], 'owner')
+    return 1
+    """
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.lease_script = self.redis.register_script(self.LEASE_SCRIPT)
+        self.reclaim_script = self.redis.register_script(self.RECLAIM_SCRIPT)
+        self.heartbeat_script = self.redis.register_script(self.HEARTBEAT_SCRIPT)
+        self.complete_script = self.redis.register_script(self.COMPLETE_SCRIPT)
+
+    def _key(self, task_id):
+        return f"{self.TASK_PREFIX}{task_id}"
+
+    def enqueue(self, task):
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key(task['id']), mapping={'data': json.dumps(_strip(task)), 'attempts': 0})
+        pipe.zadd(self.TASKS_KEY, {task['id']: _now()})
+        pipe.lpush(self.QUEUE_KEY, task['id'])
+        pipe.execute()
+
+    def reclaim(self):
+        now = _now()
+        task_ids = self.reclaim_script(keys=[self.LEASES_KEY, self.QUEUE_KEY],
+                                       args=[now, self.TASK_PREFIX, MAX_ATTEMPTS, now + RECLAIM_SECONDS])
+        exhausted = []
+        for task_id in task_ids:
+            # 先写失败状态再移除租约；中途退出时由下一次回收重做（幂等）
+            key = self._key(task_id)
+            task = self.get(task_id) or {'id': task_id}
+            task.update(_exhausted(int(self.redis.hget(key, 'attempts') or 0)))
+            self.redis.hset(key, 'data', json.dumps(task))
+            pipe = self.redis.pipeline()
+            pipe.zrem(self.LEASES_KEY, task_id)
+            pipe.hdel(key, 'owner')
+            pipe.execute()
+            exhausted.append(task)
+        return exhausted
+
+    def lease(self, worker_id, lease_seconds):
+        leased = self.lease_script(keys=[self.QUEUE_KEY, self.LEASES_KEY],
+                                   args=[_now() + lease_seconds, worker_id, self.TASK_PREFIX])
+        if leased is None:
+            return None
+
+        task_id, attempts, data = leased
+        key = self._key(task_id)
+        task = json.loads(data)
+        task['status'] = 'running'
+        task['attempts'] = attempts
+        task['worker'] = worker_id
+        self.redis.hset(key, 'data', json.dumps(task))
+        return task
+
+    def heartbeat(self, task_id, worker_id, lease_seconds):
+        return self.heartbeat_script(keys=[self.LEASES_KEY, self._key(task_id)],
+                                     args=[task_id, worker_id, _now() + lease_seconds]) == 1
+
+    def complete(self, task_id, worker_id, task):
+        return self.complete_script(keys=[self.LEASES_KEY, self._key(task_id)],
+                                    args=[task_id, worker_id, json.dumps(_strip(task))]) == 1
+
+    def get(self, task_id):
+        data = self.redis.hget(self._key(task_id), 'data')
+        return json.loads(data) if data else None
+
+    def list(self):
+        ids = self.redis.zrange(self.TASKS_KEY, 0, -1)
+        if not ids:
+            return []
+        pipe = self.redis.pipeline()
+        for task_id in ids:
+            pipe.hget(self._key(task_id), 'data')
+        return [json.loads(data) for data in pipe.execute() if data]
+
+    def count(self):
+        return self.redis.zcard(self.TASKS_KEY)
+
+    def depth(self):
+        return self.redis.llen(self.QUEUE_KEY)
+
+def _exhausted(attempts):
+    return {
+        'status': 'failed',
+        'error': f'扫描失败: worker 多次中断，已重试 {attempts} 次',
+        'completed_at': datetime.now().isoformat()
+    }
+
+def open_queue(url):
+    """根据 QUEUE_URL 创建队列；未配置时返回 None（单进程本地线程模式）"""
+    if not url:
+        return None
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisQueue(url)
+    if url.startswith('sqlite:///'):
+        return SqliteQueue(url[len('sqlite:///'):])
+    raise ValueError(f"不支持的 QUEUE_URL: {url}")
@@ -0,0 +1,263 @@
+# backend/webhooks.py
+"""
+扫描完成回调投递
+
+任务完成后不再需要客户端轮询，服务主动向 callback_url POST 结果摘要：
+
+- 发送线程池有上限（WEBHOOK_WORKERS），不会因回调慢拖垮扫描
+- 每个发送线程按 (scheme, host, port) 复用 HTTP 连接
+- 失败（连接错误、5xx、429）按指数退避重试，其他 4xx 直接放弃
+- 同一地址在 WEBHOOK_BATCH_WINDOW 内的多个完成事件合并为一次请求；
+  同一地址同时只有一个请求在途，期间到达的事件累积到下一批
+
+请求体格式：
+
+    {"events": [{"event": "scan.completed", "task_id": "...", ...}, ...]}
+
+配置 WEBHOOK_SECRET 后，请求头 X-Scanner-Signature 携带
+请求体的 HMAC-SHA256 签名（sha256=<hex>）。
+
+回调地址由 API 调用方指定，为避免服务被用来访问内网（SSRF）：
+未配置 WEBHOOK_ALLOWED_HOSTS 时只允许解析到公网地址的主机；
+配置后（逗号分隔，.example.com 表示该域名及其子域名）只允许列表中的主机，可包含内网地址。
+创建任务时和每次投递前都会检查。
+"""
+import hashlib
+import hmac
+import http.client
+import ipaddress
+import json
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '4'))
+WEBHOOK_BATCH_WINDOW = float(os.environ.get('WEBHOOK_BATCH_WINDOW', '1.0'))
+WEBHOOK_MAX_BATCH = int(os.environ.get('WEBHOOK_MAX_BATCH', '100'))
+WEBHOOK_MAX_RETRIES = int(os.environ.get('WEBHOOK_MAX_RETRIES', '5'))
+WEBHOOK_BACKOFF_BASE = float(os.environ.get('WEBHOOK_BACKOFF_BASE', '1.0'))
+WEBHOOK_BACKOFF_MAX = float(os.environ.get('WEBHOOK_BACKOFF_MAX', '60'))
+WEBHOOK_TIMEOUT = float(os.environ.get('WEBHOOK_TIMEOUT', '10'))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_ALLOWED_HOSTS = [h.strip().lower() for h in os.environ.get('WEBHOOK_ALLOWED_HOSTS', '').split(',') if h.strip()]
+
+def _allowed_host(host):
+    host = host.lower().rstrip('.')
+    return any(host == allowed or (allowed.startswith('.') and (host == allowed[1:] or host.endswith(allowed)))
+               for allowed in WEBHOOK_ALLOWED_HOSTS)
+
+def check_callback_host(url):
+    """检查回调主机是否允许访问，返回错误信息或 None"""
+    parts = urlsplit(url)
+    if WEBHOOK_ALLOWED_HOSTS:
+        if _allowed_host(parts.hostname):
+            return None
+        return 'callback_url 的主机不在 WEBHOOK_ALLOWED_HOSTS 中'
+
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80),
+                                   proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError):
+        return f"无法解析 callback_url 的主机: {parts.hostname}"
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if not address.is_global:
+            return 'callback_url 不能指向本机、内网或链路本地地址（可通过 WEBHOOK_ALLOWED_HOSTS 放行）'
+    return None
+
+def validate_callback_url(url):
+    """校验回调地址，返回错误信息或 None"""
+    if not isinstance(url, str):
+        return 'callback_url 必须是字符串'
+    try:
+        parts = urlsplit(url)
+        parts.port
+    except ValueError:
+        return 'callback_url 格式不正确'
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        return 'callback_url 必须是 http 或 https 地址'
+    return check_callback_host(url)
+
+class WebhookDispatcher:
+    """按回调地址合并、限流并重试的回调发送器"""
+
+    def __init__(self, workers=WEBHOOK_WORKERS, batch_window=WEBHOOK_BATCH_WINDOW,
+                 max_batch=WEBHOOK_MAX_BATCH, max_retries=WEBHOOK_MAX_RETRIES,
+                 backoff_base=WEBHOOK_BACKOFF_BASE, backoff_max=WEBHOOK_BACKOFF_MAX,
+                 timeout=WEBHOOK_TIMEOUT, secret=WEBHOOK_SECRET):
+        self.workers = workers
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.secret = secret.encode() if secret else b''
+
+        self.cond = threading.Condition()
+        self.pending = {}     # url -> [event, ...]
+        self.deadlines = {}   # url -> 最晚发送时间
+        self.inflight = set()
+        self.closed = False
+        self.pool = None
+        self.flusher = None
+        self.local = threading.local()
+        self.stats = {'events': 0, 'batches': 0, 'delivered': 0, 'retries': 0, 'dropped': 0}
+
+    def _start(self):
+        if self.flusher is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='webhook')
+            self.flusher = threading.Thread(target=self._flush_loop, name='webhook-flusher')
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def submit(self, url, event):
+        """登记一个待投递事件"""
+        with self.cond:
+            if self.closed:
+                return
+            self._start()
+            self.pending.setdefault(url, []).append(event)
+            self.deadlines.setdefault(url, time.monotonic() + self.batch_window)
+            self.stats['events'] += 1
+            if len(self.pending[url]) >= self.max_batch:
+                self.deadlines[url] = 0
+            self.cond.notify()
+
+    def _flush_loop(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                ready = [url for url, deadline in self.deadlines.items()
+                         if url not in self.inflight and (deadline <= now or self.closed)]
+                for url in ready:
+                    events = self.pending.pop(url)
+                    del self.deadlines[url]
+                    batch, rest = events[:self.max_batch], events[self.max_batch:]
+                    if rest:
+                        # 超出单批上限的部分在本批完成后立即发送，保持同一地址串行
+                        self.pending[url] = rest
+                        self.deadlines[url] = 0
+                    self.inflight.add(url)
+                    self.pool.submit(self._deliver, url, batch)
+
+                if self.closed and not self.pending and not self.inflight:
+                    return
+
+                waits = [d - now for url, d in self.deadlines.items() if url not in self.inflight]
+                self.cond.wait(max(0.0, min(waits)) if waits else None)
+
+    def _connection(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = self.local.conns = {}
+        conn = conns.get(key)
+        if conn is None:
+            cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            conn = conns[key] = cls(parts.hostname, parts.port, timeout=self.timeout)
+        return key, conn
+
+    def _drop_connection(self, key):
+        conn = self.local.conns.pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    def _post(self, url, body):
+        """发送一次请求，返回 HTTP 状态码；连接错误时抛出 OSError"""
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = {'Content-Type': 'application/json', 'User-Agent': 'trivy-scanner-webhook'}
+        if self.secret:
+            digest = hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+            headers['X-Scanner-Signature'] = f"sha256={digest}"
+
+        key, conn = self._connection(url)
+        try:
+            conn.request('POST', path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+        except (OSError, http.client.HTTPException) as e:
+            self._drop_connection(key)
+            raise OSError(str(e))
+        if resp.will_close:
+            self._drop_connection(key)
+        return resp.status
+
+    def _deliver(self, url, events):
+        body = json.dumps({'events': events}, ensure_ascii=False).encode('utf-8')
+        try:
+            # 域名解析结果可能在创建任务后改变，投递前再检查一次
+            error = check_callback_host(url)
+            if error:
+                print(f"回调地址被拒绝 {url}（{len(events)} 个事件）: {error}")
+                with self.cond:
+                    self.stats['dropped'] += len(events)
+                return
+
+            for attempt in range(self.max_retries + 1):
+                try:
+                    status = self._post(url, body)
+                    if status < 300:
+                        with self.cond:
+                            self.stats['batches'] += 1
+                            self.stats['delivered'] += len(events)
+                        return
+                    error = f"HTTP {status}"
+                    if status < 500 and status != 429:
+                        break
+                except OSError as e:
+                    error = str(e)
+
+                if attempt < self.max_retries:
+                    delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+                    delay *= random.uniform(0.5, 1.0)
+                    with self.cond:
+                        self.stats['retries'] += 1
+                    time.sleep(delay)
+
+            print(f"回调投递失败 {url}（{len(events)} 个事件）: {error}")
+            with self.cond:
+                self.stats['dropped'] += len(events)
+        finally:
+            with self.cond:
+                self.inflight.discard(url)
+                self.cond.notify()
+
+    def get_stats(self):
+        with self.cond:
+            return dict(self.stats, pending=sum(len(v) for v in self.pending.values()))
+
+    def close(self, timeout=30):
+        """立即发送剩余事件并等待投递结束"""
+        with self.cond:
+            if self.flusher is None:
+                return
+            self.closed = True
+            self.cond.notify()
+        self.flusher.join(timeout)
+        self.pool.shutdown(wait=False)
+
+def completion_event(task):
+    """由任务生成回调事件"""
+    event = {
+        'event': f"scan.{task['status']}",
+        'task_id': task['id'],
+        'type': task['type'],
+        'target': task['target'],
+        'status': task['status'],
+        'created_at': task.get('created_at'),
+        'completed_at': task.get('completed_at')
+    }
+    for key in ('batch_id', 'stats', 'error'):
+        if key in task:
+            event[key] = task[key]
+    return event
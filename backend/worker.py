@@ -0,0 +1,116 @@
+# backend/worker.py
+"""
+扫描 worker 节点
+
+从 QUEUE_URL 指向的共享队列领取任务并执行 trivy 扫描，
+结果文件写入共享的 SCAN_RESULTS_DIR，状态回写到共享存储。
+每个 worker 进程并发执行 WORKER_CONCURRENCY 个扫描，
+增加 worker 容器即可线性提升吞吐量：
+
+    docker-compose up -d --scale worker=4
+"""
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+
+import app as scanner
+
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', str(os.cpu_count() or 1)))
+LEASE_SECONDS = int(os.environ.get('WORKER_LEASE_SECONDS', '60'))
+HEARTBEAT_SECONDS = int(os.environ.get('WORKER_HEARTBEAT_SECONDS', str(max(1, LEASE_SECONDS // 3))))
+POLL_SECONDS = float(os.environ.get('WORKER_POLL_SECONDS', '1'))
+
+stop_event = threading.Event()
+
+def heartbeat_loop(queue, task_id, worker_id, done):
+    """扫描期间定期续约；租约丢失只记录日志，最终提交时会被拒绝"""
+    while not done.wait(HEARTBEAT_SECONDS):
+        try:
+            alive = queue.heartbeat(task_id, worker_id, LEASE_SECONDS)
+        except Exception as e:
+            # 存储暂时不可用时继续尝试，租约尚未过期前恢复即可
+            print(f"[{task_id}] 续约失败: {e}")
+            continue
+        if not alive:
+            print(f"[{task_id}] 租约已丢失，任务可能已被重新投递")
+            return
+
+def process_task(queue, worker_id, task):
+    task_id = task['id']
+    scanner.scan_tasks[task_id] = task
+
+    done = threading.Event()
+    beat = threading.Thread(target=heartbeat_loop, args=(queue, task_id, worker_id, done))
+    beat.daemon = True
+    beat.start()
+
+    try:
+        scanner.run_trivy_scan(task_id, task['type'], task['target'], task.get('options', {}))
+    finally:
+        done.set()
+        beat.join()
+
+    if queue.complete(task_id, worker_id, scanner.scan_tasks[task_id]):
+        # 先提交状态再回调，保证回调方收到通知后查询到的已是最终状态
+        scanner.notify_completion(task_id)
+    else:
+        print(f"[{task_id}] 提交结果失败：租约已被其他 worker 接管")
+    scanner.scan_tasks.pop(task_id, None)
+
+def worker_loop(queue, worker_id):
+    while not stop_event.is_set():
+        try:
+            for failed in queue.reclaim():
+                # 多次中断的任务已在存储中标记失败，这里补发 scan.failed 回调
+                print(f"[{failed['id']}] 超过最大投递次数，标记为失败")
+                scanner.notify_completion(failed['id'], failed)
+            task = queue.lease(worker_id, LEASE_SECONDS)
+        except Exception as e:
+            print(f"[{worker_id}] 领取任务失败: {e}")
+            stop_event.wait(POLL_SECONDS)
+            continue
+
+        if task is None:
+            stop_event.wait(POLL_SECONDS)
+            continue
+
+        print(f"[{task['id']}] 由 {worker_id} 领取（第 {task.get('attempts', 1)} 次投递）")
+        try:
+            process_task(queue, worker_id, task)
+        except Exception as e:
+            # 结果未能提交时租约会到期，任务由其他 worker 重新执行；本线程继续领取
+            print(f"[{task['id']}] 提交结果失败: {e}")
+            scanner.scan_tasks.pop(task['id'], None)
+            stop_event.wait(POLL_SECONDS)
+
+def main():
+    if scanner.task_queue is None:
+        raise SystemExit('worker 需要配置 QUEUE_URL')
+
+    os.makedirs(scanner.SCAN_RESULTS_DIR, exist_ok=True)
+    node_id = f"{socket.gethostname()}-{uuid.uuid4().hex[:6]}"
+
+    def handle_signal(signum, frame):
+        print(f"[{node_id}] 收到信号 {signum}，完成当前任务后退出")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    threads = []
+    for i in range(WORKER_CONCURRENCY):
+        thread = threading.Thread(target=worker_loop, args=(scanner.task_queue, f"{node_id}-{i}"))
+        thread.start()
+        threads.append(thread)
+
+    print(f"[{node_id}] worker 已启动，并发 {WORKER_CONCURRENCY}，租约 {LEASE_SECONDS}s")
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(0.5)
+    
+    scanner.webhook_dispatcher.close()
+
+if __name__ == '__main__':
+    main()